@@ -21,6 +21,7 @@ import textwrap
 
 from keystone import config
 from keystone.common import openssl
+from keystone import exception
 from keystone.openstack.common import importutils
 from keystone.openstack.common import jsonutils
 
@@ -56,6 +57,24 @@ class DbSync(BaseApp):
                 driver.db_sync()
 
 
+class TokenFlush(BaseApp):
+    """Purge expired tokens from the token backend."""
+
+    name = 'token_flush'
+
+    def __init__(self, *args, **kw):
+        super(TokenFlush, self).__init__(*args, **kw)
+
+    def main(self):
+        driver = importutils.import_object(CONF.token.driver)
+        try:
+            count = driver.flush_expired_tokens()
+        except exception.NotImplemented:
+            sys.exit('Token driver %s does not support flushing expired '
+                     'tokens' % CONF.token.driver)
+        print 'Flushed %d expired tokens' % count
+
+
 class PKISetup(BaseApp):
     """Set up Key pairs and certificates for token signing and verification."""
 
@@ -125,6 +144,7 @@ CMDS = {'db_sync': DbSync,
         'export_legacy_catalog': ExportLegacyCatalog,
         'import_nova_auth': ImportNovaAuth,
         'pki_setup': PKISetup,
+        'token_flush': TokenFlush,
         }
 
 
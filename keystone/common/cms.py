@@ -1,25 +1,272 @@
+import ctypes
+import ctypes.util
+import os
 import subprocess
 
+import eventlet.patcher
+from eventlet import tpool
+
 from keystone.common import logging
+from keystone.common import processpool
 
 
 LOG = logging.getLogger(__name__)
 UUID_TOKEN_LENGTH = 32
 
+# flags matching the openssl cms command line options used below:
+# -nocerts -noattr -nosmimecap
+CMS_NOCERTS = 0x2
+CMS_NOATTR = 0x100
+CMS_NOSMIMECAP = 0x200
+CMS_FLAGS = CMS_NOCERTS | CMS_NOATTR | CMS_NOSMIMECAP
+
+BIO_CTRL_INFO = 3
+
+# serializes every use of libcrypto; a native lock, as the calls are made
+# from tpool threads when eventlet is in use
+_libcrypto_lock = eventlet.patcher.original('thread').allocate_lock()
+
+
+def _offload(func, *args):
+    """Runs CPU bound work in a native thread when eventlet is in use."""
+    if processpool.is_green():
+        return tpool.execute(func, *args)
+    return func(*args)
+
+
+class LibCrypto(object):
+    """Signs and verifies CMS documents in-process through libcrypto.
+
+    This calls the same libcrypto functions, with the same flags, as the
+    ``openssl cms`` commands in this module, so its output is byte for byte
+    what the command line tool produces. Certificates, keys and CA stores
+    are loaded once and reused until their file changes on disk, when they
+    are freed.
+
+    Only one thread at a time calls into libcrypto, so that a certificate
+    is never freed while in use and OpenSSL versions before 1.1 need no
+    locking callbacks.
+
+    Failures raise :class:`subprocess.CalledProcessError`, like the command
+    line tool does, with openssl's error messages as its output.
 
-def cms_verify(formatted, signing_cert_file_name, ca_file_name):
     """
-        verifies the signature of the contents IAW CMS syntax
+
+    def __init__(self, lib):
+        self._lib = lib
+        self._files = {}
+        self._declare()
+        # OpenSSL 1.0 needs its tables loaded, later versions do it lazily
+        if hasattr(lib, 'OPENSSL_add_all_algorithms_noconf'):
+            lib.OPENSSL_add_all_algorithms_noconf()
+            lib.ERR_load_crypto_strings()
+
+    @classmethod
+    def load(cls):
+        """Returns an instance bound to the system libcrypto, or None."""
+        name = ctypes.util.find_library('crypto')
+        if not name:
+            return None
+        try:
+            return cls(ctypes.CDLL(name))
+        except (OSError, AttributeError):
+            LOG.debug('Unable to use %s for CMS, using openssl instead', name)
+            return None
+
+    def _declare(self):
+        lib = self._lib
+        ptr, int_, uint, char_p = (ctypes.c_void_p, ctypes.c_int,
+                                   ctypes.c_uint, ctypes.c_char_p)
+
+        def declare(name, restype, *argtypes):
+            f = getattr(lib, name)
+            f.restype = restype
+            f.argtypes = argtypes
+            return f
+
+        self.BIO_new_file = declare('BIO_new_file', ptr, char_p, char_p)
+        self.BIO_new_mem_buf = declare('BIO_new_mem_buf', ptr, char_p, int_)
+        self.BIO_s_mem = declare('BIO_s_mem', ptr)
+        self.BIO_new = declare('BIO_new', ptr, ptr)
+        self.BIO_ctrl = declare('BIO_ctrl', ctypes.c_long,
+                                ptr, int_, ctypes.c_long, ptr)
+        self.BIO_free = declare('BIO_free', int_, ptr)
+        self.PEM_read_bio_X509 = declare('PEM_read_bio_X509',
+                                         ptr, ptr, ptr, ptr, ptr)
+        self.PEM_read_bio_PrivateKey = declare('PEM_read_bio_PrivateKey',
+                                               ptr, ptr, ptr, ptr, ptr)
+        self.PEM_read_bio_CMS = declare('PEM_read_bio_CMS',
+                                        ptr, ptr, ptr, ptr, ptr)
+        self.PEM_write_bio_CMS = declare('PEM_write_bio_CMS', int_, ptr, ptr)
+        self.CMS_sign = declare('CMS_sign', ptr, ptr, ptr, ptr, ptr, uint)
+        self.CMS_verify = declare('CMS_verify', int_,
+                                  ptr, ptr, ptr, ptr, ptr, uint)
+        self.CMS_ContentInfo_free = declare('CMS_ContentInfo_free', None, ptr)
+        self.X509_STORE_new = declare('X509_STORE_new', ptr)
+        self.X509_STORE_load_locations = declare('X509_STORE_load_locations',
+                                                 int_, ptr, char_p, char_p)
+        self.X509_STORE_free = declare('X509_STORE_free', None, ptr)
+        self.X509_free = declare('X509_free', None, ptr)
+        self.EVP_PKEY_free = declare('EVP_PKEY_free', None, ptr)
+        # the stack functions were renamed in OpenSSL 1.1
+        prefix = 'OPENSSL_' if hasattr(lib, 'OPENSSL_sk_new_null') else ''
+        self.sk_new_null = declare(prefix + 'sk_new_null', ptr)
+        self.sk_push = declare(prefix + 'sk_push', int_, ptr, ptr)
+        self.sk_free = declare(prefix + 'sk_free', None, ptr)
+        self.ERR_get_error = declare('ERR_get_error', ctypes.c_ulong)
+        self.ERR_error_string_n = declare('ERR_error_string_n', None,
+                                          ctypes.c_ulong, char_p,
+                                          ctypes.c_size_t)
+
+    def _error(self, message):
+        """Raise the pending openssl errors, the way the command line does."""
+        errors = [message]
+        buf = ctypes.create_string_buffer(256)
+        code = self.ERR_get_error()
+        while code:
+            self.ERR_error_string_n(code, buf, len(buf))
+            errors.append(buf.value)
+            code = self.ERR_get_error()
+        output = '\n'.join(errors)
+        LOG.error('CMS error: %s' % output)
+        raise subprocess.CalledProcessError(1, 'openssl', output=output)
+
+    def _read_bio(self, bio):
+        data = ctypes.c_char_p()
+        length = self.BIO_ctrl(bio, BIO_CTRL_INFO, 0, ctypes.byref(data))
+        return ctypes.string_at(data, length)
+
+    def _load_pem(self, file_name, kind):
+        """Load and cache a certificate, private key or CA store."""
+        try:
+            mtime = os.path.getmtime(file_name)
+        except OSError:
+            self._error('Error opening %s file %s' % (kind, file_name))
+        cached = self._files.get((kind, file_name))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        free = {'CA': self.X509_STORE_free,
+                'certificate': self.X509_free}.get(kind, self.EVP_PKEY_free)
+
+        if kind == 'CA':
+            obj = self.X509_STORE_new()
+            if not self.X509_STORE_load_locations(obj, file_name, None):
+                self.X509_STORE_free(obj)
+                self._error('Error loading CA file %s' % file_name)
+        else:
+            bio = self.BIO_new_file(file_name, 'r')
+            if not bio:
+                self._error('Error opening %s file %s' % (kind, file_name))
+            try:
+                if kind == 'certificate':
+                    obj = self.PEM_read_bio_X509(bio, None, None, None)
+                else:
+                    obj = self.PEM_read_bio_PrivateKey(bio, None, None, None)
+            finally:
+                self.BIO_free(bio)
+            if not obj:
+                self._error('Error reading %s file %s' % (kind, file_name))
+
+        self._files[(kind, file_name)] = (mtime, obj)
+        if cached is not None:
+            free(cached[1])
+        return obj
+
+    def _locked(self, func, *args):
+        with _libcrypto_lock:
+            return func(*args)
+
+    def sign(self, text, signing_cert_file_name, signing_key_file_name):
+        return _offload(self._locked, self._sign, text,
+                        signing_cert_file_name, signing_key_file_name)
+
+    def _sign(self, text, signing_cert_file_name, signing_key_file_name):
+        cert = self._load_pem(signing_cert_file_name, 'certificate')
+        key = self._load_pem(signing_key_file_name, 'private key')
+        data = self.BIO_new_mem_buf(text, len(text))
+        out = self.BIO_new(self.BIO_s_mem())
+        cms = None
+        try:
+            cms = self.CMS_sign(cert, key, None, data, CMS_FLAGS)
+            if not cms or not self.PEM_write_bio_CMS(out, cms):
+                self._error('Error creating CMS structure')
+            return self._read_bio(out)
+        finally:
+            if cms:
+                self.CMS_ContentInfo_free(cms)
+            self.BIO_free(out)
+            self.BIO_free(data)
+
+    def verify(self, formatted, signing_cert_file_name, ca_file_name):
+        return _offload(self._locked, self._verify, formatted,
+                        signing_cert_file_name, ca_file_name)
+
+    def _verify(self, formatted, signing_cert_file_name, ca_file_name):
+        cert = self._load_pem(signing_cert_file_name, 'certificate')
+        store = self._load_pem(ca_file_name, 'CA')
+        data = self.BIO_new_mem_buf(formatted, len(formatted))
+        out = self.BIO_new(self.BIO_s_mem())
+        certs = self.sk_new_null()
+        cms = None
+        try:
+            self.sk_push(certs, cert)
+            cms = self.PEM_read_bio_CMS(data, None, None, None)
+            if not cms:
+                self._error('Error reading S/MIME message')
+            if self.CMS_verify(cms, certs, store, None, out, CMS_FLAGS) != 1:
+                self._error('Verification failure')
+            return self._read_bio(out)
+        finally:
+            if cms:
+                self.CMS_ContentInfo_free(cms)
+            self.sk_free(certs)
+            self.BIO_free(out)
+            self.BIO_free(data)
+
+
+_libcrypto = None
+_libcrypto_loaded = False
+
+
+def get_libcrypto():
+    """Returns the in-process implementation, or None without libcrypto.
+
+    The library is loaded on first use rather than on import, so processes
+    that never sign or verify, or only hand the work to a pool of worker
+    processes, do not load it.
+
     """
-    process = subprocess.Popen(["openssl", "cms", "-verify",
-                                "-certfile", signing_cert_file_name,
-                                "-CAfile", ca_file_name,
-                                "-inform", "PEM",
-                                "-nosmimecap", "-nodetach",
-                                "-nocerts", "-noattr"],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
+    global _libcrypto, _libcrypto_loaded
+    if not _libcrypto_loaded:
+        _libcrypto = LibCrypto.load()
+        _libcrypto_loaded = True
+    return _libcrypto
+
+
+# when set to a processpool.WorkerPool, CMS operations are sent to its
+# worker processes
+pool = None
+
+
+def _pool_call(func, *args):
+    try:
+        return pool.call(func, *args)
+    except processpool.WorkerError as e:
+        LOG.error('CMS error: %s' % e)
+        raise subprocess.CalledProcessError(e.returncode, 'openssl',
+                                            output=str(e))
+
+
+def _openssl_verify(formatted, signing_cert_file_name, ca_file_name):
+    process = processpool.popen(["openssl", "cms", "-verify",
+                                 "-certfile", signing_cert_file_name,
+                                 "-CAfile", ca_file_name,
+                                 "-inform", "PEM",
+                                 "-nosmimecap", "-nodetach",
+                                 "-nocerts", "-noattr"],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
     output, err = process.communicate(formatted)
     retcode = process.poll()
     if retcode:
@@ -28,6 +275,24 @@ def cms_verify(formatted, signing_cert_file_name, ca_file_name):
     return output
 
 
+def _verify(formatted, signing_cert_file_name, ca_file_name):
+    libcrypto = get_libcrypto()
+    if libcrypto is not None:
+        return libcrypto.verify(formatted, signing_cert_file_name,
+                                ca_file_name)
+    return _openssl_verify(formatted, signing_cert_file_name, ca_file_name)
+
+
+def cms_verify(formatted, signing_cert_file_name, ca_file_name):
+    """
+        verifies the signature of the contents IAW CMS syntax
+    """
+    if pool is not None:
+        return _pool_call(_verify, formatted, signing_cert_file_name,
+                          ca_file_name)
+    return _verify(formatted, signing_cert_file_name, ca_file_name)
+
+
 def token_to_cms(signed_text):
     copy_of_text = signed_text.replace('-', '/')
 
@@ -53,21 +318,16 @@ def verify_token(token, signing_cert_file_name, ca_file_name):
                       ca_file_name)
 
 
-def cms_sign_text(text, signing_cert_file_name, signing_key_file_name):
-    """ Uses OpenSSL to sign a document
-    Produces a Base64 encoding of a DER formatted CMS Document
-    http://en.wikipedia.org/wiki/Cryptographic_Message_Syntax
-    """
-
-    process = subprocess.Popen(["openssl", "cms", "-sign",
-                                "-signer", signing_cert_file_name,
-                                "-inkey", signing_key_file_name,
-                                "-outform", "PEM",
-                                "-nosmimecap", "-nodetach",
-                                "-nocerts", "-noattr"],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
+def _openssl_sign(text, signing_cert_file_name, signing_key_file_name):
+    process = processpool.popen(["openssl", "cms", "-sign",
+                                 "-signer", signing_cert_file_name,
+                                 "-inkey", signing_key_file_name,
+                                 "-outform", "PEM",
+                                 "-nosmimecap", "-nodetach",
+                                 "-nocerts", "-noattr"],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
     output, err = process.communicate(text)
     retcode = process.poll()
     if retcode:
@@ -77,6 +337,25 @@ def cms_sign_text(text, signing_cert_file_name, signing_key_file_name):
     return output
 
 
+def _sign_text(text, signing_cert_file_name, signing_key_file_name):
+    libcrypto = get_libcrypto()
+    if libcrypto is not None:
+        return libcrypto.sign(text, signing_cert_file_name,
+                              signing_key_file_name)
+    return _openssl_sign(text, signing_cert_file_name, signing_key_file_name)
+
+
+def cms_sign_text(text, signing_cert_file_name, signing_key_file_name):
+    """ Uses OpenSSL to sign a document
+    Produces a Base64 encoding of a DER formatted CMS Document
+    http://en.wikipedia.org/wiki/Cryptographic_Message_Syntax
+    """
+    if pool is not None:
+        return _pool_call(_sign_text, text, signing_cert_file_name,
+                          signing_key_file_name)
+    return _sign_text(text, signing_cert_file_name, signing_key_file_name)
+
+
 def cms_sign_token(text, signing_cert_file_name, signing_key_file_name):
     output = cms_sign_text(text, signing_cert_file_name, signing_key_file_name)
     return cms_to_token(output)
@@ -0,0 +1,214 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pre-fork worker processes for keystone-all.
+
+The parent process opens the listening sockets, forks the workers, which
+inherit them and accept connections from the same queue, and then only
+supervises: it restarts workers that exit unexpectedly and stops them on
+SIGTERM or SIGINT.
+
+On SIGHUP a new generation of workers is forked, and the previous one is
+sent SIGTERM once they run, so the listening sockets never close.
+
+"""
+
+import errno
+import mmap
+import os
+import signal
+import struct
+import time
+
+import eventlet.hubs
+
+from keystone.common import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ProcessLauncher(object):
+    """Forks worker processes and keeps them running."""
+
+    # minimum seconds between two starts of the same worker slot, so a
+    # worker failing on startup does not turn into a fork loop
+    restart_interval = 1
+
+    def __init__(self):
+        self.children = {}
+        self.retiring = set()
+        self.running = True
+        self._run = None
+        self._reload = None
+        self._reload_requested = False
+        self._started = {}
+        self._pid = os.getpid()
+        # workers are started in a generation, and told to exit by raising
+        # the retired generation in memory shared with them, as well as by
+        # SIGTERM: python drops signals that reach a forked child before
+        # it has reinitialized its signal handling
+        self._generation = 1
+        self._retired = mmap.mmap(-1, struct.calcsize('!I'))
+        self._set_retired(0)
+
+    def launch(self, run, workers, reload=None):
+        """Fork ``workers`` processes, each calling ``run(slot)``.
+
+        ``slot`` numbers the workers from 0, and a restarted worker takes
+        over the slot of the one it replaces. Workers are expected to finish
+        their requests in progress and exit on SIGTERM.
+
+        :param reload: called in the parent on SIGHUP, before the new
+                       generation of workers is forked
+
+        """
+        self._run = run
+        self._reload = reload
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        for slot in range(workers):
+            self._start_child(slot)
+
+    def _start_child(self, slot):
+        last_start = self._started.get(slot)
+        if last_start is not None:
+            delay = last_start + self.restart_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self._started[slot] = time.time()
+
+        pid = os.fork()
+        if pid:
+            LOG.info('Started worker %d in slot %d', pid, slot)
+            self.children[pid] = slot
+            return pid
+
+        status = 0
+        try:
+            self._child_setup()
+            if self._generation > self._get_retired():
+                self._run(slot)
+        except BaseException:
+            LOG.exception('Worker in slot %d failed', slot)
+            status = 1
+        finally:
+            # never unwind into the parent's stack
+            os._exit(status)
+
+    def _child_setup(self):
+        # the parent's event hub, and the file descriptors it polls, must
+        # not be shared with the child
+        eventlet.hubs.use_hub()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # the parent turns ^C into a SIGTERM for every worker, and reloads
+        # by replacing them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def _handle_stop(self, signo, frame):
+        if os.getpid() != self._pid:
+            # a worker signalled before it replaced our handlers
+            os._exit(1)
+        LOG.info('Caught signal %d, stopping workers', signo)
+        self.running = False
+        self._stop_children()
+
+    def _handle_reload(self, signo, frame):
+        # the interrupted os.wait() returns to wait(), which reloads
+        if os.getpid() == self._pid:
+            self._reload_requested = True
+
+    def reload(self):
+        """Replace every worker by a new one.
+
+        The new workers are forked first and then the old ones are sent
+        SIGTERM, so that the listening sockets stay open and served.
+
+        """
+        LOG.info('Reloading workers')
+        if self._reload is not None:
+            try:
+                self._reload()
+            except Exception:
+                LOG.exception('Reload failed, keeping the current workers')
+                return
+        old_children = self.children
+        self.children = {}
+        self._started = {}
+        self._generation += 1
+        for slot in sorted(old_children.values()):
+            self._start_child(slot)
+        self.retiring.update(old_children)
+        self._set_retired(self._generation - 1)
+        self._signal(old_children, signal.SIGTERM)
+
+    def _stop_children(self):
+        self._set_retired(self._generation)
+        self._signal(list(self.children) + list(self.retiring),
+                     signal.SIGTERM)
+
+    def _get_retired(self):
+        return struct.unpack('!I', self._retired[:])[0]
+
+    def _set_retired(self, generation):
+        self._retired[:] = struct.pack('!I', generation)
+
+    def _signal(self, pids, signo):
+        for pid in pids:
+            try:
+                os.kill(pid, signo)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _wait_child(self):
+        """Reap one worker, restarting it unless we are stopping."""
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                self.children.clear()
+                self.retiring.clear()
+            elif e.errno != errno.EINTR:
+                raise
+            return None
+        if pid in self.retiring:
+            self.retiring.discard(pid)
+            return None
+        slot = self.children.pop(pid, None)
+        if slot is None:
+            return None
+        if self.running:
+            LOG.error('Worker %d in slot %d exited with status %d, '
+                      'restarting it', pid, slot, status)
+            return self._start_child(slot)
+        return None
+
+    def wait(self):
+        """Supervise the workers until all of them have stopped."""
+        while self.children or self.retiring:
+            if self._reload_requested and self.running:
+                self._reload_requested = False
+                self.reload()
+            self._wait_child()
+
+    def stop(self):
+        """Terminate the workers and wait for them to exit."""
+        self.running = False
+        self._stop_children()
+        self.wait()
@@ -0,0 +1,262 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pool of long-lived helper processes for CPU bound work.
+
+A pool runs module level functions in python worker processes, which
+answer pickled requests framed over their stdin and stdout pipes. This
+keeps work that holds the GIL, such as crypt or openssl calls, from
+stalling the eventlet hub of the calling process.
+
+"""
+
+import cPickle as pickle
+import os
+import Queue
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import eventlet.patcher
+from eventlet.green import select as green_select
+from eventlet.green import subprocess as green_subprocess
+
+from keystone.common import logging
+from keystone import exception
+
+
+LOG = logging.getLogger(__name__)
+
+
+def is_green():
+    """Whether blocking calls have to be kept off the eventlet hub."""
+    return eventlet.patcher.is_monkey_patched('thread')
+
+
+def popen(*args, **kwargs):
+    """Starts a subprocess whose pipes cooperate with eventlet if in use."""
+    if is_green():
+        return green_subprocess.Popen(*args, **kwargs)
+    return subprocess.Popen(*args, **kwargs)
+
+
+class WorkerError(Exception):
+    """A worker process timed out or exited while handling a request."""
+
+    def __init__(self, message, returncode):
+        super(WorkerError, self).__init__(message)
+        self.returncode = returncode
+
+
+class WorkerPool(object):
+    """Runs functions in a pool of long-lived worker processes.
+
+    Workers are started on first use, so a pool can be created before the
+    process forks. A request that does not complete within ``timeout``
+    seconds kills its worker, and a worker that died is replaced by a fresh
+    one on the next request; both raise :class:`WorkerError`. Exceptions
+    raised by the function itself are re-raised in the caller.
+
+    Once ``backlog`` requests are already waiting for a busy worker, new
+    requests are rejected with :class:`keystone.exception.ServiceUnavailable`
+    instead of queueing up.
+
+    """
+
+    def __init__(self, size, timeout=None, backlog=None):
+        self.size = size
+        self.timeout = timeout
+        self.backlog = backlog
+        self._idle = Queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def call(self, func, *args):
+        with self._lock:
+            if (self.backlog is not None and
+                    self._pending >= self.size + self.backlog):
+                raise exception.ServiceUnavailable()
+            self._pending += 1
+        try:
+            self._slots.acquire()
+            try:
+                worker = self._get_worker()
+                try:
+                    result = worker.call(func, args, self.timeout)
+                except WorkerError:
+                    worker.kill()
+                    raise
+                self._idle.put(worker)
+            finally:
+                self._slots.release()
+        finally:
+            with self._lock:
+                self._pending -= 1
+        succeeded, value = result
+        if succeeded:
+            return value
+        raise _load_error(*value)
+
+    def _get_worker(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Queue.Empty:
+                return _Worker()
+            if worker.alive():
+                return worker
+            LOG.warning('Worker %d exited with %s, replacing it',
+                        worker.pid, worker.process.returncode)
+
+    def close(self):
+        """Stops the idle workers; busy ones exit when they finish."""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Queue.Empty:
+                return
+            worker.kill()
+
+
+class _Worker(object):
+    """A single worker process and its end of the request protocol."""
+
+    def __init__(self):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p])
+        self.process = popen(
+            [sys.executable, '-m', __name__], env=env, close_fds=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.pid = self.process.pid
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def _fail(self, message):
+        raise WorkerError('Worker %d %s' % (self.pid, message),
+                          self.process.poll() or -signal.SIGKILL)
+
+    def _read(self, size, deadline):
+        fd = self.process.stdout.fileno()
+        wait = green_select.select if is_green() else select.select
+        data = ''
+        while len(data) < size:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._fail('timed out')
+            if not wait([fd], [], [], remaining)[0]:
+                self._fail('timed out')
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                self._fail('exited unexpectedly')
+            data += chunk
+        return data
+
+    def call(self, func, args, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            _write_message(self.process.stdin,
+                           (func.__module__, func.__name__, args))
+        except (IOError, OSError):
+            self._fail('exited unexpectedly')
+        length, = struct.unpack('!I', self._read(4, deadline))
+        return pickle.loads(self._read(length, deadline))
+
+
+def _write_message(stream, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    stream.write(struct.pack('!I', len(data)) + data)
+    stream.flush()
+
+
+def _read_message(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    length, = struct.unpack('!I', header)
+    return pickle.loads(stream.read(length))
+
+
+def _dump_error(e):
+    # not every exception survives pickling, e.g. CalledProcessError, so
+    # they are rebuilt from their class, args and attributes instead
+    return (type(e).__module__, type(e).__name__, e.args, dict(e.__dict__))
+
+
+def _load_error(module_name, class_name, args, attrs):
+    try:
+        cls = getattr(__import__(module_name, fromlist=[class_name]),
+                      class_name)
+    except (ImportError, AttributeError):
+        return exception.UnexpectedError(
+            exception='%s.%s%r' % (module_name, class_name, args))
+    try:
+        error = cls(*args)
+    except TypeError:
+        error = cls.__new__(cls)
+        error.args = args
+    error.__dict__.update(attrs)
+    return error
+
+
+def _worker_main():
+    """Serves requests on stdin until the parent closes it."""
+    # keep the protocol stream to ourselves, anything else printed by
+    # libraries goes to stderr
+    requests = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        request = _read_message(requests)
+        if request is None:
+            return
+        module_name, func_name, args = request
+        try:
+            module = __import__(module_name, fromlist=[func_name])
+            result = (True, getattr(module, func_name)(*args))
+        except Exception as e:
+            result = (False, _dump_error(e))
+        try:
+            _write_message(responses, result)
+        except (pickle.PicklingError, TypeError) as e:
+            _write_message(responses, (False, _dump_error(
+                exception.UnexpectedError(exception=e))))
+
+
+if __name__ == '__main__':
+    _worker_main()
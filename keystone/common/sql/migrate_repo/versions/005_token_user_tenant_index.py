@@ -0,0 +1,89 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import Column, Index, MetaData, String, Table
+
+from keystone.openstack.common import jsonutils
+
+
+# number of token rows backfilled per UPDATE round trip
+BATCH_SIZE = 1000
+
+
+def _owner_ids(extra):
+    try:
+        extra = jsonutils.loads(extra) if extra else {}
+    except ValueError:
+        extra = {}
+    user_id = (extra.get('user') or {}).get('id')
+    tenant_id = (extra.get('tenant') or {}).get('id')
+    return user_id, tenant_id
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    token = Table('token', meta, autoload=True)
+    if 'user_id' not in token.c:
+        token.create_column(Column('user_id', String(64)))
+    if 'tenant_id' not in token.c:
+        token.create_column(Column('tenant_id', String(64)))
+
+    meta = MetaData()
+    meta.bind = migrate_engine
+    token = Table('token', meta, autoload=True)
+
+    # backfill the owner columns from the JSON blob in bounded batches, so
+    # that a large token table is never read or locked in one go
+    last_id = ''
+    while True:
+        rows = migrate_engine.execute(
+            token.select()
+                 .with_only_columns([token.c.id, token.c.extra])
+                 .where(token.c.id > last_id)
+                 .order_by(token.c.id)
+                 .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        connection = migrate_engine.connect()
+        transaction = connection.begin()
+        for token_id, extra in rows:
+            user_id, tenant_id = _owner_ids(extra)
+            connection.execute(token.update()
+                                    .where(token.c.id == token_id)
+                                    .values(user_id=user_id,
+                                            tenant_id=tenant_id))
+        transaction.commit()
+        connection.close()
+        last_id = rows[-1][0]
+
+    Index('ix_token_user_id', token.c.user_id).create(migrate_engine)
+    Index('ix_token_tenant_id', token.c.tenant_id).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    token = Table('token', meta, autoload=True)
+    Index('ix_token_user_id', token.c.user_id).drop(migrate_engine)
+    Index('ix_token_tenant_id', token.c.tenant_id).drop(migrate_engine)
+    # Note: reflect again so the dropped indexes are not recreated when
+    # sqlite rebuilds the table to drop the columns
+    meta = MetaData()
+    meta.bind = migrate_engine
+    token = Table('token', meta, autoload=True)
+    token.drop_column('user_id')
+    token.drop_column('tenant_id')
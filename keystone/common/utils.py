@@ -19,22 +19,30 @@
 #    under the License.
 
 import base64
+import copy
+import datetime
 import hashlib
 import hmac
 import json
 import os
 import subprocess
+import threading
 import time
 import urllib
 
 import passlib.hash
 
 from keystone.common import logging
+from keystone.common import processpool
 from keystone import config
+from keystone.openstack.common import timeutils
 
 
 CONF = config.CONF
 config.register_int('crypt_strength', default=40000)
+config.register_int('crypt_workers', default=0)
+config.register_int('crypt_backlog', default=64)
+config.register_int('crypt_timeout', default=10)
 
 LOG = logging.getLogger(__name__)
 
@@ -154,14 +162,42 @@ def trunc_password(password):
         return password
 
 
+# pool of processes hashing passwords, created on first use
+_crypt_pool = None
+
+
+def _crypt_call(func, *args):
+    """Run crypt work in the crypt worker processes, if configured.
+
+    Hashing holds the GIL for the whole computation, so in the calling
+    process it would stall every other greenthread while it runs.
+
+    """
+    global _crypt_pool
+    if not CONF.crypt_workers:
+        return func(*args)
+    if _crypt_pool is None:
+        _crypt_pool = processpool.WorkerPool(CONF.crypt_workers,
+                                             timeout=CONF.crypt_timeout,
+                                             backlog=CONF.crypt_backlog)
+    return _crypt_pool.call(func, *args)
+
+
+def _sha512_crypt_encrypt(password_utf8, rounds):
+    return passlib.hash.sha512_crypt.encrypt(password_utf8, rounds=rounds)
+
+
+def _sha512_crypt_verify(password_utf8, hashed):
+    return passlib.hash.sha512_crypt.verify(password_utf8, hashed)
+
+
 def hash_password(password):
     """Hash a password. Hard."""
     password_utf8 = trunc_password(password).encode('utf-8')
     if passlib.hash.sha512_crypt.identify(password_utf8):
         return password_utf8
-    h = passlib.hash.sha512_crypt.encrypt(password_utf8,
-                                          rounds=CONF.crypt_strength)
-    return h
+    return _crypt_call(_sha512_crypt_encrypt, password_utf8,
+                       CONF.crypt_strength)
 
 
 def ldap_hash_password(password):
@@ -188,7 +224,7 @@ def check_password(password, hashed):
     if password is None:
         return False
     password_utf8 = trunc_password(password).encode('utf-8')
-    return passlib.hash.sha512_crypt.verify(password_utf8, hashed)
+    return _crypt_call(_sha512_crypt_verify, password_utf8, hashed)
 
 
 # From python 2.7
@@ -240,6 +276,178 @@ def unixtime(dt_obj):
     return time.mktime(dt_obj.utctimetuple())
 
 
+def parse_utc_isotime(timestr):
+    """Parse an ISO 8601 timestamp into a naive utc datetime.
+
+    :param timestr: ISO 8601 timestamp, in any timezone
+    :returns: datetime.datetime object
+    :raises: ValueError
+
+    """
+    at = timeutils.parse_isotime(timestr)
+    offset = at.utcoffset() or datetime.timedelta(0)
+    return at.replace(tzinfo=None) - offset
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('%s object is read-only' % type(self).__name__)
+
+
+class FrozenDict(dict):
+    """A dict that refuses in-place modification.
+
+    Frozen values can be shared freely instead of being copied defensively;
+    :meth:`copy` and ``copy.copy`` give a plain, mutable dict of the same
+    items and ``copy.deepcopy`` a fully mutable copy.
+
+    """
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((k, copy.deepcopy(v, memo)) for k, v in self.iteritems())
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """A list that refuses in-place modification; see :class:`FrozenDict`."""
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """Return a read-only version of value, freezing nested dicts and lists.
+
+    Values that are already frozen are returned as they are, so re-freezing
+    shared data costs nothing.
+
+    """
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+class LRUCache(object):
+    """A size-bounded mapping whose entries may also expire.
+
+    Reading an entry marks it as recently used; once ``size`` entries are
+    held, adding another evicts the least recently used one. Entries may
+    also be given a cost, e.g. their approximate size in bytes, in which
+    case the least recently used ones are evicted to keep the total within
+    ``max_cost``. ``hits`` and ``misses`` count the outcome of every
+    :meth:`get`. The cache may be shared between threads.
+
+    """
+
+    _PREV, _NEXT, _KEY, _VALUE, _EXPIRES, _COST = range(6)
+
+    def __init__(self, size, max_cost=None):
+        self.size = size
+        self.max_cost = max_cost
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly linked list, most recently used first
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None, 0]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _unlink(self, entry):
+        entry[self._PREV][self._NEXT] = entry[self._NEXT]
+        entry[self._NEXT][self._PREV] = entry[self._PREV]
+
+    def _link(self, entry):
+        root = self._root
+        entry[self._PREV] = root
+        entry[self._NEXT] = root[self._NEXT]
+        root[self._NEXT][self._PREV] = entry
+        root[self._NEXT] = entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+            self.cost -= entry[self._COST]
+
+    def get(self, key, default=None):
+        """Returns the value for key, or default if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires = entry[self._EXPIRES]
+                if expires is None or expires > timeutils.utcnow():
+                    self._unlink(entry)
+                    self._link(entry)
+                    self.hits += 1
+                    return entry[self._VALUE]
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires=None, cost=0):
+        """Stores value for key.
+
+        :param expires: naive utc datetime after which the entry is dropped,
+                        or None to keep it until evicted.
+        :param cost: counted against ``max_cost``; an entry costing more
+                     than ``max_cost`` on its own is not stored.
+
+        """
+        with self._lock:
+            self._remove(key)
+            if self.size <= 0:
+                return
+            if self.max_cost is not None and cost > self.max_cost:
+                return
+            while self._entries and (
+                    len(self._entries) >= self.size or
+                    (self.max_cost is not None and
+                     self.cost + cost > self.max_cost)):
+                self._remove(self._root[self._PREV][self._KEY])
+            entry = [None, None, key, value, expires, cost]
+            self._link(entry)
+            self._entries[key] = entry
+            self.cost += cost
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None, None, 0]
+            self.cost = 0
+
+
 def auth_str_equal(provided, known):
     """Constant-time string comparison.
 
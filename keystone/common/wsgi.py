@@ -20,9 +20,12 @@
 
 """Utility methods for working with WSGI servers."""
 
+import socket
 import sys
 
+import eventlet.event
 import eventlet.wsgi
+import greenlet
 import routes.middleware
 import ssl
 import webob.dec
@@ -48,6 +51,62 @@ class WritableLogger(object):
         self.logger.log(self.level, msg)
 
 
+class _Listener(object):
+    """Listening socket whose accept() can be suspended.
+
+    Ending eventlet's accept loop shuts down every connection, including
+    those with a request in progress, so once :meth:`stop` is called the
+    loop is parked in here until those requests are done.
+
+    """
+
+    # seconds between checks of whether the server is stopping, while no
+    # connection comes in
+    accept_timeout = 1
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._stopping = False
+
+    def stop(self):
+        """Stop accepting connections."""
+        self._stopping = True
+
+    def accept(self):
+        while not self._stopping:
+            timeout = self._socket.gettimeout()
+            self._socket.settimeout(self.accept_timeout)
+            try:
+                return self._socket.accept()
+            except socket.timeout:
+                pass
+            finally:
+                self._socket.settimeout(timeout)
+        # wait to be killed
+        eventlet.event.Event().wait()
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+class _Response(object):
+    """Response body which tells the server when it has been sent."""
+
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._done()
+
+
 class Server(object):
     """Server class to manage multiple WSGI sockets and applications."""
 
@@ -56,13 +115,22 @@ class Server(object):
         self.host = host or '0.0.0.0'
         self.port = port or 0
         self.pool = eventlet.GreenPool(threads)
+        self.socket = None
         self.socket_info = {}
         self.greenthread = None
+        self._listener = None
+        self._requests = 0
+        self._drained = None
         self.do_ssl = False
         self.cert_required = False
 
-    def start(self, key=None, backlog=128):
-        """Run a WSGI server with the given application."""
+    def listen(self, key=None, backlog=128):
+        """Open the listening socket without serving on it yet.
+
+        Forked worker processes inherit the socket and share its
+        connections when they start serving.
+
+        """
         LOG.debug('Starting %(arg0)s on %(host)s:%(port)s' %
                   {'arg0': sys.argv[0],
                    'host': self.host,
@@ -82,8 +150,17 @@ class Server(object):
                                           cert_reqs=cert_reqs,
                                           ca_certs=self.ca_certs)
             socket = sslsocket
+        self.socket = socket
 
-        self.greenthread = self.pool.spawn(self._run, self.application, socket)
+    def start(self, key=None, backlog=128):
+        """Run a WSGI server with the given application."""
+        if self.socket is None:
+            self.listen(key=key, backlog=backlog)
+        # the accept loop runs outside of the pool serving requests, so
+        # that it can wait for them when it is stopped
+        self._listener = _Listener(self.socket)
+        self.greenthread = eventlet.spawn(self._run, self._dispatch,
+                                          self._listener)
 
     def set_ssl(self, certfile, keyfile=None, ca_certs=None,
                 cert_required=True):
@@ -97,13 +174,52 @@ class Server(object):
         if self.greenthread:
             self.greenthread.kill()
 
+    def stop(self, timeout=None):
+        """Stop accepting connections and finish the requests in progress.
+
+        Requests still running after ``timeout`` seconds are killed, as are
+        idle keep-alive connections.
+
+        """
+        if self.greenthread is None:
+            return
+        self._listener.stop()
+        if self._requests:
+            self._drained = eventlet.event.Event()
+            with eventlet.Timeout(timeout, False):
+                self._drained.wait()
+        self.kill()
+        for request in list(self.pool.coroutines_running):
+            request.kill()
+
     def wait(self):
         """Wait until all servers have completed running."""
         try:
+            # a greenthread that has not run yet is false
+            if self.greenthread is not None:
+                self.greenthread.wait()
             self.pool.waitall()
-        except KeyboardInterrupt:
+        except (greenlet.GreenletExit, KeyboardInterrupt):
             pass
 
+    def _dispatch(self, environ, start_response):
+        # the application is looked up for every request, so replacing it
+        # moves new requests over while those in progress finish on the
+        # previous one
+        self._requests += 1
+        try:
+            body = self.application(environ, start_response)
+        except BaseException:
+            self._request_done()
+            raise
+        return _Response(body, self._request_done)
+
+    def _request_done(self):
+        self._requests -= 1
+        if (not self._requests and self._drained is not None and
+                not self._drained.ready()):
+            self._drained.send()
+
     def _run(self, application, socket):
         """Start a WSGI server in a new green thread."""
         log = logging.getLogger('eventlet.wsgi.server')
@@ -191,6 +307,7 @@ class Application(BaseApplication):
         # allow middleware up the stack to provide context & params
         context = req.environ.get('openstack.context', {})
         context['query_string'] = dict(req.params.iteritems())
+        context['headers'] = dict(req.headers.iteritems())
         params = req.environ.get('openstack.params', {})
         params.update(arg_dict)
 
@@ -116,6 +116,8 @@ register_str('compute_port', default=8774)
 register_str('admin_port', default=35357)
 register_str('public_port', default=5000)
 register_str('onready')
+register_int('workers', default=1)
+register_int('graceful_timeout', default=30)
 register_str('auth_admin_prefix', default='')
 
 #ssl options
@@ -136,6 +138,8 @@ register_str('ca_certs', group='signing',
 register_int('key_size', group='signing', default=1024)
 register_int('valid_days', group='signing', default=3650)
 register_str('ca_password', group='signing', default=None)
+register_int('worker_pool_size', group='signing', default=0)
+register_int('worker_timeout', group='signing', default=10)
 
 
 # sql options
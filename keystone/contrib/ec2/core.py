@@ -155,9 +155,7 @@ class Ec2Controller(wsgi.Application):
                                           credentials['access'])
         self.check_signature(creds_ref, credentials)
 
-        # TODO(termie): don't create new tokens every time
         # TODO(termie): this is copied from TokenController.authenticate
-        token_id = uuid.uuid4().hex
         tenant_ref = self.identity_api.get_tenant(
             context=context,
             tenant_id=creds_ref['tenant_id'])
@@ -174,11 +172,15 @@ class Ec2Controller(wsgi.Application):
             tenant_id=tenant_ref['id'],
             metadata=metadata_ref)
 
-        token_ref = self.token_api.create_token(
-            context, token_id, dict(id=token_id,
-                                    user=user_ref,
-                                    tenant=tenant_ref,
-                                    metadata=metadata_ref))
+        token_ref = self.token_api.find_reusable_token(
+            context, user_ref['id'], tenant_ref['id'], metadata_ref)
+        if token_ref is None:
+            token_id = uuid.uuid4().hex
+            token_ref = self.token_api.create_token(
+                context, token_id, dict(id=token_id,
+                                        user=user_ref,
+                                        tenant=tenant_ref,
+                                        metadata=metadata_ref))
 
         # TODO(termie): optimize this call at some point and put it into the
         #               the return for metadata
@@ -127,3 +127,9 @@ class NotImplemented(Error):
     """The action you have requested has not been implemented."""
     code = 501
     title = 'Not Implemented'
+
+
+class ServiceUnavailable(Error):
+    """The server is too busy to handle your request, try again later."""
+    code = 503
+    title = 'Service Unavailable'
@@ -93,17 +93,26 @@ HTTP_X_ROLE
 
 """
 
+import collections
 import datetime
 import httplib
 import json
 import logging
 import os
+import socket
 import stat
 import subprocess
+import sys
+import threading
 import time
+import urllib
 import webob
 import webob.exc
 
+import eventlet
+import eventlet.event
+import greenlet
+
 from keystone.openstack.common import jsonutils
 from keystone.common import cms
 from keystone.common import utils
@@ -155,9 +164,20 @@ opts = [
     cfg.StrOpt('signing_dir'),
     cfg.ListOpt('memcache_servers'),
     cfg.IntOpt('token_cache_time', default=300),
+    cfg.IntOpt('token_cache_size', default=1000),
+    cfg.IntOpt('token_cache_max_bytes', default=10 * 1024 * 1024),
+    cfg.IntOpt('revocation_cache_time', default=1),
+    cfg.BoolOpt('background_refresh', default=True),
+    cfg.IntOpt('revocation_refresh_interval', default=300),
+    cfg.IntOpt('revocation_full_sync_interval', default=3600),
+    cfg.IntOpt('http_connection_pool_size', default=10),
+    cfg.IntOpt('http_connection_idle_timeout', default=60),
 ]
 CONF.register_opts(opts, group='keystone_authtoken')
 
+# seconds a refreshing revocation list may be older than revocation_cache_time
+REVOCATION_REFRESH_GRACE = 5
+
 
 class InvalidUserToken(Exception):
     pass
@@ -171,6 +191,138 @@ class ConfigurationError(Exception):
     pass
 
 
+# requests that may be sent again when a pooled connection fails after
+# sending them, as keystone handling them twice is harmless
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+class HTTPConnectionPool(object):
+    """Keeps idle keep-alive connections to the auth service for reuse.
+
+    Connections idle for longer than ``idle_timeout`` seconds are closed
+    rather than reused, and at most ``size`` of them are kept. The pool
+    belongs to the process that filled it: a forked child starts with an
+    empty pool instead of sharing the connections of its parent. The pool
+    may be shared between threads.
+
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.deque()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return an idle connection, or None if there is none left."""
+        conn = None
+        expired_conns = []
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle.clear()
+                self._pid = os.getpid()
+            expired = time.time() - self.idle_timeout
+            while self._idle and self._idle[0][1] <= expired:
+                expired_conns.append(self._idle.popleft()[0])
+            if self._idle:
+                conn, released = self._idle.pop()
+        for expired_conn in expired_conns:
+            expired_conn.close()
+        return conn
+
+    def put(self, conn):
+        """Return a connection to the pool, or close it if the pool is full."""
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            conns = [conn for conn, released in self._idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+class _SingleFlight(object):
+    """Runs a single call per key at a time.
+
+    Callers asking for a key while its call is in progress wait for that
+    call and share its outcome, its return value or its exception, instead
+    of making the same call again.
+
+    The lock only guards the bookkeeping and is never held while waiting,
+    so it may be a native lock even in a greenthread.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func, *args):
+        with self._lock:
+            pending = self._calls.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._calls[key] = _PendingCall()
+
+        if not leader:
+            pending.done.wait()
+            if pending.exc_info:
+                raise pending.exc_info[0], pending.exc_info[1], \
+                    pending.exc_info[2]
+            return pending.result
+
+        try:
+            pending.result = func(*args)
+            return pending.result
+        except Exception:
+            pending.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            pending.done.set()
+
+
+class _PendingCall(object):
+    def __init__(self):
+        if _in_greenthread():
+            self.done = _GreenEvent()
+        else:
+            self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+def _in_greenthread():
+    """Whether the caller runs in an eventlet greenthread.
+
+    Services such as swift use eventlet without patching ``thread``, in
+    which case waiting on a ``threading.Event`` would block the whole hub.
+
+    """
+    return greenlet.getcurrent().parent is not None
+
+
+class _GreenEvent(object):
+    """An eventlet event with the interface of ``threading.Event``."""
+
+    def __init__(self):
+        self._event = eventlet.event.Event()
+
+    def wait(self):
+        self._event.wait()
+
+    def set(self):
+        self._event.send()
+
+
 class AuthProtocol(object):
     """Auth Middleware that handles authenticating client calls."""
 
@@ -193,6 +345,10 @@ class AuthProtocol(object):
         else:
             self.http_client_class = httplib.HTTPSConnection
 
+        self._connection_pool = HTTPConnectionPool(
+            int(self._conf_get('http_connection_pool_size')),
+            int(self._conf_get('http_connection_idle_timeout')))
+
         self.auth_admin_prefix = self._conf_get('auth_admin_prefix')
         self.auth_uri = self._conf_get('auth_uri')
         if self.auth_uri is None:
@@ -240,10 +396,42 @@ class AuthProtocol(object):
         memcache_servers = self._conf_get('memcache_servers')
         # By default the token will be cached for 5 minutes
         self.token_cache_time = int(self._conf_get('token_cache_time'))
+        # Tokens are also cached in process, in front of memcache if used
+        self._local_cache = utils.LRUCache(
+            int(self._conf_get('token_cache_size')),
+            max_cost=int(self._conf_get('token_cache_max_bytes')))
+        # concurrent validations of the same token are made only once
+        self._validations = _SingleFlight()
         self._token_revocation_list = None
         self._token_revocation_list_fetched_time = None
-        self.token_revocation_list_cache_timeout = \
-            datetime.timedelta(seconds=0)
+        # the revoked token ids as a set, and the list they were taken from
+        self._revoked_ids = (None, frozenset())
+        self.token_revocation_list_cache_timeout = datetime.timedelta(
+            seconds=int(self._conf_get('revocation_cache_time')))
+        # deltas are only applied to a list fully fetched within this time,
+        # so that a revocation missed by a delta is not missed for good
+        self.revocation_full_sync_interval = datetime.timedelta(
+            seconds=int(self._conf_get('revocation_full_sync_interval')))
+        self._token_revocation_list_synced_time = None
+        # the since time and ETag of the last revocation list fetched, sent
+        # back so that keystone only returns it again once it changed
+        self._revocation_list_etag = (None, None)
+        # the revocation list is refreshed, and the certificates fetched,
+        # by a thread each process starts when it first checks a PKI token
+        self.background_refresh = (self._conf_get('background_refresh') in
+                                   (True, 'true', 't', '1', 'on', 'yes', 'y'))
+        self.revocation_refresh_interval = int(
+            self._conf_get('revocation_refresh_interval'))
+        # a list older than revocation_cache_time is used while the thread
+        # refreshes it, but no longer than this: past it, the thread is
+        # taken as stuck and the list fetched on the request
+        self.revocation_refresh_grace = datetime.timedelta(
+            seconds=REVOCATION_REFRESH_GRACE)
+        self._refresher_lock = threading.Lock()
+        self._refresher_pid = None
+        # guards replacing the revocation list; it is never held while
+        # fetching, so that it does not block greenthreads either
+        self._revocation_lock = threading.Lock()
         if memcache_servers:
             try:
                 import memcache
@@ -363,6 +551,54 @@ class AuthProtocol(object):
                                           self.key_file,
                                           self.cert_file)
 
+    def _send_request(self, method, path, **kwargs):
+        """Send a request over a pooled keep-alive connection.
+
+        Keystone may have closed a connection while it sat in the pool, so
+        a request failing on a reused connection is sent again on a new one,
+        provided it is idempotent or failed before it was sent in full.
+
+        :return (http response object, response body)
+        :raise ServerError when unable to communicate with keystone
+
+        """
+        conn = None
+        reused = False
+        while True:
+            sent = False
+            try:
+                if conn is None:
+                    conn = self._connection_pool.get()
+                    reused = conn is not None
+                    if not reused:
+                        conn = self._get_http_connection()
+                conn.request(method, path, **kwargs)
+                sent = True
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                if conn is not None:
+                    conn.close()
+                if not reused or (sent and
+                                  method not in IDEMPOTENT_METHODS):
+                    LOG.error('HTTP connection exception: %s' % e)
+                    raise ServiceError('Unable to communicate with keystone')
+                LOG.debug('Pooled connection failed, reconnecting: %s' % e)
+                conn = self._get_http_connection()
+                reused = False
+            except Exception, e:
+                if conn is not None:
+                    conn.close()
+                LOG.error('HTTP connection exception: %s' % e)
+                raise ServiceError('Unable to communicate with keystone')
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._connection_pool.put(conn)
+        return response, body
+
     def _http_request(self, method, path):
         """HTTP request helper used to make unspecified content type requests.
 
@@ -372,19 +608,7 @@ class AuthProtocol(object):
         :raise ServerError when unable to communicate with keystone
 
         """
-        conn = self._get_http_connection()
-
-        try:
-            conn.request(method, path)
-            response = conn.getresponse()
-            body = response.read()
-        except Exception, e:
-            LOG.error('HTTP connection exception: %s' % e)
-            raise ServiceError('Unable to communicate with keystone')
-        finally:
-            conn.close()
-
-        return response, body
+        return self._send_request(method, path)
 
     def _json_request(self, method, path, body=None, additional_headers=None):
         """HTTP request helper used to make json requests.
@@ -398,8 +622,6 @@ class AuthProtocol(object):
         :raise ServerError when unable to communicate with keystone
 
         """
-        conn = self._get_http_connection()
-
         kwargs = {
             'headers': {
                 'Content-type': 'application/json',
@@ -414,15 +636,7 @@ class AuthProtocol(object):
             kwargs['body'] = jsonutils.dumps(body)
 
         full_path = self.auth_admin_prefix + path
-        try:
-            conn.request(method, full_path, **kwargs)
-            response = conn.getresponse()
-            body = response.read()
-        except Exception, e:
-            LOG.error('HTTP connection exception: %s' % e)
-            raise ServiceError('Unable to communicate with keystone')
-        finally:
-            conn.close()
+        response, body = self._send_request(method, full_path, **kwargs)
 
         try:
             data = jsonutils.loads(body)
@@ -474,20 +688,40 @@ class AuthProtocol(object):
         try:
             cached = self._cache_get(user_token)
             if cached:
+                # a signed token may have been revoked since it was cached
+                if (len(user_token) > cms.UUID_TOKEN_LENGTH and
+                        self.is_signed_token_revoked(user_token)):
+                    self._cache_store_invalid(user_token)
+                    raise InvalidUserToken('Token has been revoked')
                 return cached
-            if (len(user_token) > cms.UUID_TOKEN_LENGTH):
-                verified = self.verify_signed_token(user_token)
-                data = json.loads(verified)
-            else:
-                data = self.verify_uuid_token(user_token, retry)
-            self._cache_put(user_token, data)
-            return data
+            if not retry:
+                # retrying from within the validation already in flight
+                return self._verify_user_token(user_token, retry)
+            return self._validations.call(user_token,
+                                          self._verify_user_token,
+                                          user_token, retry)
         except Exception as e:
+            # only definitive rejections are cached as invalid, a failure
+            # to reach keystone or to fetch its certificates is not
             LOG.debug('Token validation failure.', exc_info=True)
-            self._cache_store_invalid(user_token)
             LOG.warn("Authorization failed for token %s", user_token)
             raise InvalidUserToken('Token authorization failed')
 
+    def _verify_user_token(self, user_token, retry):
+        """Validate a token missing from the cache, and cache the result."""
+        if (len(user_token) > cms.UUID_TOKEN_LENGTH):
+            try:
+                verified = self.verify_signed_token(user_token)
+            except (InvalidUserToken, subprocess.CalledProcessError):
+                # revoked, or not signed by keystone
+                self._cache_store_invalid(user_token)
+                raise
+            data = json.loads(verified)
+            self._cache_put(user_token, data, size=len(verified))
+        else:
+            data = self.verify_uuid_token(user_token, retry)
+        return data
+
     def _build_user_headers(self, token_info):
         """Convert token object into headers.
 
@@ -590,40 +824,80 @@ class AuthProtocol(object):
         env_key = self._header_to_env_var(key)
         return env.get(env_key, default)
 
+    def _local_cache_put(self, token, value, expires=None, size=None):
+        """Put token data, or the 'invalid' marker, into the local cache.
+
+        Entries are kept for at most token_cache_time seconds, and never
+        past ``expires`` (naive utc), the expiry of the token itself. Each
+        is charged against token_cache_max_bytes at the length of the token
+        and of its serialized data; ``size`` is that of the data, if already
+        known, which spares serializing it again.
+
+        """
+        cache_until = timeutils.utcnow() + datetime.timedelta(
+            seconds=self.token_cache_time)
+        if expires is not None:
+            cache_until = min(cache_until, expires)
+        if size is None:
+            size = 0 if value == 'invalid' else len(jsonutils.dumps(value))
+        self._local_cache.set(token, value, expires=cache_until,
+                              cost=len(token) + size)
+
     def _cache_get(self, token):
         """Return token information from cache.
 
         If token is invalid raise InvalidUserToken
         return token only if fresh (not expired).
         """
-        if self._cache and token:
+        if not token:
+            return
+        cached = self._local_cache.get(token)
+        if cached == 'invalid':
+            LOG.debug('Cached Token %s is marked unauthorized', token)
+            raise InvalidUserToken('Token authorization failed')
+        if cached:
+            LOG.debug('Returning cached token %s', token)
+            return cached
+        if self._cache:
             key = 'tokens/%s' % token
             cached = self._cache.get(key)
             if cached == 'invalid':
                 LOG.debug('Cached Token %s is marked unauthorized', token)
+                self._local_cache_put(token, 'invalid')
                 raise InvalidUserToken('Token authorization failed')
             if cached:
                 data, expires = cached
-                if time.time() < float(expires):
+                remaining = float(expires) - time.time()
+                if remaining > 0:
                     LOG.debug('Returning cached token %s', token)
+                    self._local_cache_put(
+                        token, data, timeutils.utcnow() +
+                        datetime.timedelta(seconds=remaining))
                     return data
                 else:
                     LOG.debug('Cached Token %s seems expired', token)
 
-    def _cache_put(self, token, data):
+    def _cache_put(self, token, data, size=None):
         """Put token data into the cache.
 
         Stores the parsed expire date in cache allowing
-        quick check of token freshness on retrieval.
+        quick check of token freshness on retrieval. ``size`` is the length
+        of the serialized data, if known.
         """
-        if self._cache and data:
+        if not data:
+            return
+        if 'token' not in data.get('access', {}):
+            LOG.error('invalid token format')
+            return
+        timestamp = data['access']['token'].get('expires')
+        if timestamp:
+            self._local_cache_put(token, data,
+                                  utils.parse_utc_isotime(timestamp), size)
+        else:
+            self._local_cache_put(token, data, size=size)
+        if self._cache and timestamp:
             key = 'tokens/%s' % token
-            if 'token' in data.get('access', {}):
-                timestamp = data['access']['token']['expires']
-                expires = self._iso8601.parse_date(timestamp).strftime('%s')
-            else:
-                LOG.error('invalid token format')
-                return
+            expires = self._iso8601.parse_date(timestamp).strftime('%s')
             LOG.debug('Storing %s token in memcache', token)
             self._cache.set(key,
                             (data, expires),
@@ -631,6 +905,7 @@ class AuthProtocol(object):
 
     def _cache_store_invalid(self, token):
         """Store invalid token in cache."""
+        self._local_cache_put(token, 'invalid')
         if self._cache:
             key = 'tokens/%s' % token
             LOG.debug('Marking token %s as unauthorized in memcache', token)
@@ -684,19 +959,31 @@ class AuthProtocol(object):
 
             raise InvalidUserToken()
 
+    def _get_revoked_ids(self):
+        """Return the ids of the revoked tokens as a set.
+
+        The set is built once for every revocation list, rather than the
+        list being scanned for every token.
+
+        """
+        revocation_list = self.token_revocation_list
+        source, revoked_ids = self._revoked_ids
+        if source is not revocation_list:
+            revoked_ids = frozenset(
+                x['id'] for x in revocation_list.get('revoked', []))
+            self._revoked_ids = (revocation_list, revoked_ids)
+        return revoked_ids
+
     def is_signed_token_revoked(self, signed_text):
         """Indicate whether the token appears in the revocation list."""
-        revocation_list = self.token_revocation_list
-        revoked_tokens = revocation_list.get('revoked', [])
-        if not revoked_tokens:
+        self._start_refresher()
+        revoked_ids = self._get_revoked_ids()
+        if not revoked_ids:
             return
-        revoked_ids = (x['id'] for x in revoked_tokens)
         token_id = utils.hash_signed_token(signed_text)
-        for revoked_id in revoked_ids:
-            if token_id == revoked_id:
-                LOG.debug('Token %s is marked as having been revoked',
-                          token_id)
-                return True
+        if token_id in revoked_ids:
+            LOG.debug('Token %s is marked as having been revoked', token_id)
+            return True
         return False
 
     def cms_verify(self, data):
@@ -755,10 +1042,98 @@ class AuthProtocol(object):
             if not self._token_revocation_list:
                 with open(self.revoked_file_name, 'r') as f:
                     self._token_revocation_list = jsonutils.loads(f.read())
-        else:
-            self.token_revocation_list = self.fetch_revocation_list()
+        elif not (self._token_revocation_list and self._is_refreshing() and
+                  timeutils.utcnow() < timeout +
+                  self.revocation_refresh_grace):
+            # otherwise the background refresh replaces the list, which is
+            # used until then, for a short grace period at most
+            self._update_revocation_list()
         return self._token_revocation_list
 
+    def _update_revocation_list(self):
+        synced_time = self._token_revocation_list_synced_time
+        now = timeutils.utcnow()
+        if (self._token_revocation_list and synced_time is not None and
+                now < synced_time + self.revocation_full_sync_interval):
+            # only ask for what changed since the list we already have
+            since = self._token_revocation_list.get('timestamp')
+            delta = self.fetch_revocation_list(since)
+            with self._revocation_lock:
+                if delta is None:
+                    self.token_revocation_list_fetched_time = now
+                else:
+                    self.token_revocation_list = \
+                        self._merge_revocation_list(delta)
+        else:
+            value = self.fetch_revocation_list()
+            with self._revocation_lock:
+                if value is None:
+                    self.token_revocation_list_fetched_time = now
+                else:
+                    self.token_revocation_list = value
+                self._token_revocation_list_synced_time = now
+
+    def _is_refreshing(self):
+        return self._refresher_pid == os.getpid()
+
+    def _start_refresher(self):
+        """Start the background refresh, once in every process.
+
+        It is started when the first PKI token is checked, so deployments
+        using UUID tokens never fetch the revocation list, and not when the
+        middleware is created, as services may fork their workers after
+        loading their paste pipeline. Under eventlet it runs in a
+        greenthread, even where ``thread`` is not monkey patched.
+
+        """
+        if not self.background_refresh or self._is_refreshing():
+            return
+        with self._refresher_lock:
+            if self._is_refreshing():
+                return
+            self._refresher_pid = os.getpid()
+            if _in_greenthread():
+                eventlet.spawn_n(self._refresh_loop)
+            else:
+                refresher = threading.Thread(target=self._refresh_loop)
+                refresher.daemon = True
+                refresher.start()
+
+    def _refresh_loop(self):
+        """Refresh the revocation list every revocation_refresh_interval.
+
+        It is refreshed at least every revocation_cache_time, however, so
+        that the list used is never older than that allows.
+
+        """
+        self._prefetch_certs()
+        cache_time = self.token_revocation_list_cache_timeout.seconds
+        interval = max(1, min(self.revocation_refresh_interval, cache_time))
+        while True:
+            self._refresh_revocation_list()
+            if _in_greenthread():
+                eventlet.sleep(interval)
+            else:
+                time.sleep(interval)
+
+    def _prefetch_certs(self):
+        for file_name, fetch in ((self.signing_cert_file_name,
+                                  self.fetch_signing_cert),
+                                 (self.ca_file_name, self.fetch_ca_cert)):
+            if os.path.exists(file_name):
+                continue
+            try:
+                fetch()
+            except Exception:
+                LOG.exception('Unable to fetch %s', file_name)
+
+    def _refresh_revocation_list(self):
+        try:
+            self._update_revocation_list()
+        except Exception:
+            LOG.exception('Unable to refresh the token revocation list, '
+                          'using the previous one')
+
     @token_revocation_list.setter
     def token_revocation_list(self, value):
         """Save a revocation list to memory and to disk.
@@ -771,15 +1146,70 @@ class AuthProtocol(object):
         with open(self.revoked_file_name, 'w') as f:
             f.write(value)
 
-    def fetch_revocation_list(self):
+    def _merge_revocation_list(self, value):
+        """Merge a revocation delta into the current revocation list.
+
+        Entries that have since expired are dropped. A full list, e.g. from a
+        server that does not support deltas, replaces the current one. A
+        delta with no new entries keeps the current timestamp, so that the
+        next poll asks for the same delta and gets a 304 while it is
+        unchanged.
+
+        :param value: A json-encoded revocation list or delta
+        :return A json-encoded revocation list
+
+        """
+        delta = jsonutils.loads(value)
+        if 'since' not in delta or not self._token_revocation_list:
+            return value
+
+        now = timeutils.utcnow()
+        current = self._token_revocation_list.get('revoked', [])
+        known = set(entry['id'] for entry in current)
+        revoked = {}
+        for entry in current:
+            expires = entry.get('expires')
+            if expires and utils.parse_utc_isotime(expires) < now:
+                continue
+            revoked[entry['id']] = entry
+        for entry in delta.get('revoked', []):
+            revoked[entry['id']] = entry
+
+        merged = {'revoked': revoked.values()}
+        if known.issuperset(revoked) and \
+                'timestamp' in self._token_revocation_list:
+            merged['timestamp'] = self._token_revocation_list['timestamp']
+        elif 'timestamp' in delta:
+            merged['timestamp'] = delta['timestamp']
+        return jsonutils.dumps(merged)
+
+    def fetch_revocation_list(self, since=None):
+        """Fetch the signed revocation list.
+
+        :param since: only fetch tokens revoked since this ISO 8601 timestamp,
+                      as returned by keystone in a previous list. Optional.
+        :return the verified, json-encoded revocation list, or None if it is
+                unchanged since it was last fetched
+
+        """
         headers = {'X-Auth-Token': self.get_admin_token()}
-        response, data = self._json_request('GET', '/v2.0/tokens/revoked',
+        etag_since, etag = self._revocation_list_etag
+        if etag and etag_since == since and self._token_revocation_list:
+            headers['If-None-Match'] = etag
+        path = '/v2.0/tokens/revoked'
+        if since:
+            path += '?%s' % urllib.urlencode({'since': since})
+        response, data = self._json_request('GET', path,
                                             additional_headers=headers)
+        if response.status == 304:
+            return None
         if response.status != 200:
             raise ServiceError('Unable to fetch token revocation list.')
         if (not 'signed' in data):
             raise ServiceError('Revocation list inmproperly formatted.')
-        return self.cms_verify(data['signed'])
+        verified = self.cms_verify(data['signed'])
+        self._revocation_list_etag = (since, response.getheader('ETag'))
+        return verified
 
     def fetch_signing_cert(self):
         response, data = self._http_request('GET',
@@ -14,6 +14,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import hashlib
 import uuid
 import routes
 import json
@@ -22,6 +24,8 @@ from keystone import config
 from keystone import catalog
 from keystone.common import cms
 from keystone.common import logging
+from keystone.common import processpool
+from keystone.common import utils
 from keystone.common import wsgi
 from keystone import exception
 from keystone import identity
@@ -250,6 +254,15 @@ class TokenController(wsgi.Application):
         self.identity_api = identity.Manager()
         self.token_api = token.Manager()
         self.policy_api = policy.Manager()
+        # signed revocation lists and deltas, by serial and since time
+        self._revocation_lists = utils.LRUCache(16)
+        # signed revocation lists by the hash of their contents, so that an
+        # unchanged list is not signed again
+        self._signed_revocation_lists = utils.LRUCache(16)
+        if config.CONF.signing.worker_pool_size and cms.pool is None:
+            cms.pool = processpool.WorkerPool(
+                config.CONF.signing.worker_pool_size,
+                timeout=config.CONF.signing.worker_timeout)
         super(TokenController, self).__init__()
 
     def ca_cert(self, context, auth=None):
@@ -409,6 +422,11 @@ class TokenController(wsgi.Application):
                                         tenant=tenant_ref,
                                         metadata=metadata_ref))
 
+        reusable_ref = self._find_reusable_token(
+            context, user_ref, tenant_ref, metadata_ref, expiry)
+        if reusable_ref is not None:
+            expiry = reusable_ref['expires']
+
         auth_token_data['expires'] = expiry
         auth_token_data['id'] = 'placeholder'
 
@@ -422,7 +440,9 @@ class TokenController(wsgi.Application):
         service_catalog = self._format_catalog(catalog_ref)
         token_data['access']['serviceCatalog'] = service_catalog
 
-        if config.CONF.signing.token_format == 'UUID':
+        if reusable_ref is not None:
+            token_id = reusable_ref['id']
+        elif config.CONF.signing.token_format == 'UUID':
             token_id = uuid.uuid4().hex
         elif config.CONF.signing.token_format == 'PKI':
 
@@ -434,26 +454,39 @@ class TokenController(wsgi.Application):
                 'Invalid value for token_format: %s.'
                 '  Allowed values are PKI or UUID.' %
                 config.CONF.signing.token_format)
-        try:
-            self.token_api.create_token(
-                context, token_id, dict(key=token_id,
-                                        id=token_id,
-                                        user=user_ref,
-                                        tenant=tenant_ref,
-                                        metadata=metadata_ref))
-        except Exception as e:
-            # an identical token may have been created already.
-            # if so, return the token_data as it is also identical
+        if reusable_ref is None:
             try:
-                self.token_api.get_token(context=context,
-                                         token_id=token_id)
-            except exception.TokenNotFound:
-                raise e
+                self.token_api.create_token(
+                    context, token_id, dict(key=token_id,
+                                            id=token_id,
+                                            user=user_ref,
+                                            tenant=tenant_ref,
+                                            metadata=metadata_ref))
+            except Exception as e:
+                # an identical token may have been created already.
+                # if so, return the token_data as it is also identical
+                try:
+                    self.token_api.get_token(context=context,
+                                             token_id=token_id)
+                except exception.TokenNotFound:
+                    raise e
 
         token_data['access']['token']['id'] = token_id
 
         return token_data
 
+    def _find_reusable_token(self, context, user_ref, tenant_ref, metadata_ref,
+                             expiry):
+        """Returns an issued token with the same scope, if one may be reused.
+
+        A reused token never outlives the expiry the new token would have
+        had.
+
+        """
+        return self.token_api.find_reusable_token(
+            context, user_ref['id'], tenant_ref and tenant_ref['id'],
+            metadata_ref, expires_before=expiry)
+
     def _get_token_ref(self, context, token_id, belongs_to=None):
         """Returns a token if a valid one exists.
 
@@ -527,20 +560,98 @@ class TokenController(wsgi.Application):
         self.token_api.delete_token(context=context, token_id=token_id)
 
     def revocation_list(self, context, auth=None):
+        """Return the signed list of revoked, unexpired tokens.
+
+        The signed document, as each delta, is cached until a token is
+        revoked, a revoked token expires or ``[token] revocation_cache_time``
+        passes, and is served with an ETag so that unchanged polls get a
+        304.
+
+        If a ``since`` timestamp is given in the query string, only the
+        tokens revoked at or after that time are returned, allowing clients
+        to keep their copy current by polling for changes. Every document
+        carries a ``timestamp`` to use as ``since`` in the next poll. Tokens
+        revoked up to ``[token] revocation_delta_overlap`` seconds earlier
+        are returned again, so that revocations committed while a previous
+        poll ran, or stamped by a keystone node whose clock is behind, are
+        not missed.
+
+        """
         self.assert_admin(context)
-        tokens = self.token_api.list_revoked_tokens(context)
+        since = context['query_string'].get('since')
+        signed_text, etag = self._get_signed_revocation_list(context, since)
+
+        if_none_match = context.get('headers', {}).get('If-None-Match', '')
+        if_none_match = [x.strip() for x in if_none_match.split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            return wsgi.render_response(status=(304, 'Not Modified'),
+                                        headers=[('ETag', etag)])
+        return wsgi.render_response(body={'signed': signed_text},
+                                    headers=[('ETag', etag)])
+
+    def _get_signed_revocation_list(self, context, since=None):
+        now = timeutils.utcnow()
+        serial = self.token_api.revocation_serial
+        cached = self._revocation_lists.get((serial, since))
+        if cached is not None and now < cached['stale_at']:
+            return cached['signed'], cached['etag']
+
+        signed_text, stale_at = self._sign_revocation_list(context, since)
+        stale_at = min(stale_at, now + datetime.timedelta(
+            seconds=config.CONF.token.revocation_cache_time))
+        etag = '"%s"' % hashlib.sha1(signed_text).hexdigest()
+
+        self._revocation_lists.set((serial, since), {'stale_at': stale_at,
+                                                     'signed': signed_text,
+                                                     'etag': etag})
+        return signed_text, etag
+
+    def _sign_revocation_list(self, context, since=None):
+        """Sign the list of tokens revoked (since a given time).
+
+        :returns: the signed document and the time the first revoked token in
+                  it expires
+
+        """
+        # read before the query, so that it never runs ahead of it
+        now = timeutils.utcnow()
+        data = {}
+        if since:
+            try:
+                since_time = utils.parse_utc_isotime(since)
+            except ValueError:
+                raise exception.ValidationError(attribute='ISO 8601 time',
+                                                target='since')
+            since_time -= datetime.timedelta(
+                seconds=config.CONF.token.revocation_delta_overlap)
+            tokens = self.token_api.list_revoked_tokens(context,
+                                                        since=since_time)
+            data['since'] = since
+        else:
+            tokens = self.token_api.list_revoked_tokens(context)
 
+        first_expiry = datetime.datetime.max
         for t in tokens:
             expires = t['expires']
-            if not (expires and isinstance(expires, unicode)):
-                    t['expires'] = timeutils.isotime(expires)
-        data = {'revoked': tokens}
-        json_data = json.dumps(data)
-        signed_text = cms.cms_sign_text(json_data,
-                                        config.CONF.signing.certfile,
-                                        config.CONF.signing.keyfile)
-
-        return {'signed': signed_text}
+            if expires and isinstance(expires, basestring):
+                expires = utils.parse_utc_isotime(expires)
+            else:
+                t['expires'] = timeutils.isotime(expires)
+            if expires and expires < first_expiry:
+                first_expiry = expires
+        data['revoked'] = sorted(tokens, key=lambda t: t['id'])
+
+        # a document signed earlier with the same contents is reused, its
+        # older timestamp only makes the next delta overlap more
+        contents = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+        signed_text = self._signed_revocation_lists.get(contents)
+        if signed_text is None:
+            data['timestamp'] = timeutils.isotime(now)
+            signed_text = cms.cms_sign_text(json.dumps(data),
+                                            config.CONF.signing.certfile,
+                                            config.CONF.signing.keyfile)
+            self._signed_revocation_lists.set(contents, signed_text)
+        return signed_text, first_expiry
 
     def endpoints(self, context, token_id):
         """Return a list of endpoints available to the token."""
@@ -583,8 +694,8 @@ class TokenController(wsgi.Application):
                         }
              }
         if 'tenant' in token_ref and token_ref['tenant']:
-            token_ref['tenant']['enabled'] = True
-            o['access']['token']['tenant'] = token_ref['tenant']
+            o['access']['token']['tenant'] = dict(token_ref['tenant'],
+                                                  enabled=True)
         if catalog_ref is not None:
             o['access']['serviceCatalog'] = self._format_catalog(catalog_ref)
         if metadata_ref:
@@ -30,6 +30,7 @@ from keystone.common import utils
 from keystone.common import wsgi
 from keystone import config
 from keystone.openstack.common import importutils
+from keystone import token
 
 
 LOG = logging.getLogger(__name__)
@@ -185,6 +186,10 @@ class TestCase(NoModule, unittest.TestCase):
                 if path in sys.path:
                     sys.path.remove(path)
             kvs.INMEMDB.clear()
+            token.Manager._cache = None
+            if utils._crypt_pool is not None:
+                utils._crypt_pool.close()
+                utils._crypt_pool = None
             CONF.reset()
 
     def opt_in_group(self, group, **kw):
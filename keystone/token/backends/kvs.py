@@ -14,15 +14,73 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import copy
+import heapq
 
 from keystone.common import kvs
+from keystone.common import utils
 from keystone import exception
 from keystone.openstack.common import timeutils
 from keystone import token
 
 
 class Token(kvs.Base, token.Driver):
+    """In-memory token backend.
+
+    Besides the tokens themselves the backend keeps per-user and per-tenant
+    token indexes, the set of revoked tokens and a heap of tokens ordered by
+    expiry, so listing never scans the shared db and expired tokens are
+    evicted as time passes.
+
+    """
+
+    # Private indexes
+    def _index(self, key, empty=None):
+        try:
+            return self.db.get(key)
+        except exception.NotFound:
+            self.db.set(key, {} if empty is None else empty)
+            return self.db.get(key)
+
+    def _discard_from_index(self, key, token_id):
+        try:
+            index = self.db.get(key)
+        except exception.NotFound:
+            return
+        index.pop(token_id, None)
+        if not index:
+            self.db.delete(key)
+
+    def _owner_keys(self, token_ref):
+        keys = []
+        user_id = (token_ref.get('user') or {}).get('id')
+        if user_id is not None:
+            keys.append('user_tokens-%s' % user_id)
+        tenant_id = (token_ref.get('tenant') or {}).get('id')
+        if tenant_id is not None:
+            keys.append('tenant_tokens-%s' % tenant_id)
+        return keys
+
+    def _unindex_token(self, token_id, token_ref):
+        for key in self._owner_keys(token_ref):
+            self._discard_from_index(key, token_id)
+
+    def _evict_expired_tokens(self):
+        heap = self._index('token_expiry_heap', [])
+        now = timeutils.utcnow()
+        count = 0
+        while heap and heap[0][0] <= now:
+            expires, token_id = heapq.heappop(heap)
+            try:
+                token_ref = self.db.get('token-%s' % token_id)
+            except exception.NotFound:
+                token_ref = None
+            if token_ref is not None and token_ref['expires'] == expires:
+                self.db.delete('token-%s' % token_id)
+                self._unindex_token(token_id, token_ref)
+                count += 1
+            if self._index('revoked_tokens').pop(token_id, None):
+                count += 1
+        return count
 
     # Public interface
     def get_token(self, token_id):
@@ -31,52 +89,67 @@ class Token(kvs.Base, token.Driver):
         except exception.NotFound:
             raise exception.TokenNotFound(token_id=token_id)
         if token['expires'] is None or token['expires'] > timeutils.utcnow():
-            return copy.deepcopy(token)
+            return dict(token)
         else:
             raise exception.TokenNotFound(token_id=token_id)
 
     def create_token(self, token_id, data):
-        data_copy = copy.deepcopy(data)
+        self._evict_expired_tokens()
+        # nested values are frozen so the stored ref can be shared
+        data_copy = dict(utils.freeze(data))
         if 'expires' not in data:
             data_copy['expires'] = self._get_default_expire_time()
         self.db.set('token-%s' % token_id, data_copy)
-        return copy.deepcopy(data_copy)
+        for key in self._owner_keys(data_copy):
+            self._index(key)[token_id] = data_copy['expires']
+        if data_copy['expires'] is not None:
+            heapq.heappush(self._index('token_expiry_heap', []),
+                           (data_copy['expires'], token_id))
+        return dict(data_copy)
 
     def delete_token(self, token_id):
         try:
             token_ref = self.get_token(token_id)
             self.db.delete('token-%s' % token_id)
-            self.db.set('revoked-token-%s' % token_id, token_ref)
         except exception.NotFound:
             raise exception.TokenNotFound(token_id=token_id)
+        self._unindex_token(token_id, token_ref)
+        self._index('revoked_tokens')[token_id] = {
+            'id': token_ref['id'],
+            'expires': token_ref['expires'],
+            'revoked_at': timeutils.utcnow()}
 
     def list_tokens(self, user_id, tenant_id=None):
-        tokens = []
-        now = timeutils.utcnow()
-        for token, ref in self.db.items():
-            if not token.startswith('token-'):
-                continue
-            if 'user' not in ref:
-                continue
-            if ref['user'].get('id') != user_id:
-                continue
-            if ref.get('expires') and ref.get('expires') < now:
-                continue
+        try:
+            user_tokens = self.db.get('user_tokens-%s' % user_id)
             if tenant_id is not None:
-                if 'tenant' not in ref:
-                    continue
-                if ref['tenant'].get('id') != tenant_id:
-                    continue
-            tokens.append(token.split('-', 1)[1])
-        return tokens
+                tenant_tokens = self.db.get('tenant_tokens-%s' % tenant_id)
+        except exception.NotFound:
+            return []
+        if tenant_id is None:
+            token_ids = user_tokens.keys()
+        elif len(tenant_tokens) < len(user_tokens):
+            token_ids = [x for x in tenant_tokens if x in user_tokens]
+        else:
+            token_ids = [x for x in user_tokens if x in tenant_tokens]
+        now = timeutils.utcnow()
+        return [x for x in token_ids
+                if user_tokens[x] is None or user_tokens[x] > now]
+
+    def revoke_tokens(self, user_id, tenant_id=None):
+        for token_id in self.list_tokens(user_id, tenant_id):
+            self.delete_token(token_id)
 
-    def list_revoked_tokens(self):
+    def list_revoked_tokens(self, since=None):
         tokens = []
-        for token, token_ref in self.db.items():
-            if not token.startswith('revoked-token-'):
+        for token_ref in self._index('revoked_tokens').itervalues():
+            if since is not None and token_ref['revoked_at'] < since:
                 continue
             record = {}
             record['id'] = token_ref['id']
             record['expires'] = token_ref['expires']
             tokens.append(record)
         return tokens
+
+    def flush_expired_tokens(self, batch_size=None):
+        return self._evict_expired_tokens()
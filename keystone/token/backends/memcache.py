@@ -15,7 +15,8 @@
 # under the License.
 
 from __future__ import absolute_import
-import copy
+import calendar
+import datetime
 
 import memcache
 
@@ -23,11 +24,13 @@ from keystone.common import utils
 from keystone import config
 from keystone import exception
 from keystone.openstack.common import jsonutils
+from keystone.openstack.common import timeutils
 from keystone import token
 
 
 CONF = config.CONF
 config.register_str('servers', group='memcache', default='localhost:11211')
+config.register_int('revocation_bucket_time', group='memcache', default=900)
 
 
 class Token(token.Driver):
@@ -42,12 +45,61 @@ class Token(token.Driver):
 
     def _get_memcache_client(self):
         memcache_servers = CONF.memcache.servers.split(',')
-        self._memcache_client = memcache.Client(memcache_servers, debug=0)
+        self._memcache_client = memcache.Client(memcache_servers, debug=0,
+                                                cache_cas=True)
         return self._memcache_client
 
     def _prefix_token_id(self, token_id):
         return 'token-%s' % token_id.encode('utf-8')
 
+    def _user_token_key(self, user_id):
+        return 'usertokens-%s' % user_id
+
+    def _get_user_tokens(self, user_id):
+        """Fetch the live token refs of a user in a single round trip.
+
+        :returns: list of (token_id, token_ref) tuples, oldest first
+
+        """
+        user_key = self._user_token_key(user_id)
+        user_record = self.client.get(user_key) or ''
+        token_ids = jsonutils.loads('[%s]' % user_record)
+        found = self.client.get_multi([self._prefix_token_id(token_id)
+                                       for token_id in token_ids])
+        token_refs = []
+        dead_ids = set()
+        for token_id in token_ids:
+            token_ref = found.get(self._prefix_token_id(token_id))
+            if token_ref:
+                token_refs.append((token_id, token_ref))
+            else:
+                dead_ids.add(token_id)
+        if dead_ids:
+            self._compact_user_record(user_key, dead_ids)
+        return token_refs
+
+    def _compact_user_record(self, user_key, dead_ids):
+        """Drop expired and deleted token ids from a user's token index.
+
+        The index is rewritten with check-and-set, so a token appended by a
+        concurrent create_token is never lost; if the record changed under us
+        the rewrite is simply left to the next reader.
+
+        """
+        user_record = self.client.gets(user_key)
+        if not user_record:
+            return
+        token_ids = jsonutils.loads('[%s]' % user_record)
+        live_ids = [token_id for token_id in token_ids
+                    if token_id not in dead_ids]
+        if len(live_ids) == len(token_ids):
+            return
+        # keep the record non-empty, since create_token appends to it with a
+        # leading comma and deleting it here would not be check-and-set
+        live_ids = live_ids or token_ids[-1:]
+        self.client.cas(user_key, ','.join(jsonutils.dumps(token_id)
+                                           for token_id in live_ids))
+
     def get_token(self, token_id):
         ptk = self._prefix_token_id(token_id)
         token = self.client.get(ptk)
@@ -57,32 +109,47 @@ class Token(token.Driver):
         return token
 
     def create_token(self, token_id, data):
-        data_copy = copy.deepcopy(data)
+        data_copy = dict(data)
         ptk = self._prefix_token_id(token_id)
         if 'expires' not in data_copy:
             data_copy['expires'] = self._get_default_expire_time()
         kwargs = {}
         if data_copy['expires'] is not None:
-            expires_ts = utils.unixtime(data_copy['expires'])
+            expires_ts = calendar.timegm(data_copy['expires'].utctimetuple())
             kwargs['time'] = expires_ts
         self.client.set(ptk, data_copy, **kwargs)
         if 'id' in data['user']:
             token_data = jsonutils.dumps(token_id)
             user_id = data['user']['id']
-            user_key = 'usertokens-%s' % user_id
+            user_key = self._user_token_key(user_id)
             if not self.client.append(user_key, ',%s' % token_data):
                 if not self.client.add(user_key, token_data):
                     if not self.client.append(user_key, ',%s' % token_data):
                         msg = _('Unable to add token user list.')
                         raise exception.UnexpectedError(msg)
-        return copy.deepcopy(data_copy)
-
-    def _add_to_revocation_list(self, data):
-        data_json = jsonutils.dumps(data)
-        if not self.client.append(self.revocation_key, ',%s' % data_json):
-            if not self.client.add(self.revocation_key, data_json):
-                if not self.client.append(self.revocation_key,
-                                          ',%s' % data_json):
+        return data_copy
+
+    def _revocation_bucket(self, at):
+        return (calendar.timegm(at.utctimetuple()) //
+                CONF.memcache.revocation_bucket_time)
+
+    def _revocation_bucket_key(self, bucket):
+        return '%s-%d' % (self.revocation_key, bucket)
+
+    def _add_to_revocation_list(self, token_refs):
+        # Revocations are grouped into keys by the time they were made. Every
+        # token in a bucket has expired once token.expiration has passed
+        # since the end of the bucket, so memcache can drop the key then.
+        revoked_at = timeutils.utcnow()
+        bucket = self._revocation_bucket(revoked_at)
+        bucket_key = self._revocation_bucket_key(bucket)
+        expires_ts = ((bucket + 1) * CONF.memcache.revocation_bucket_time +
+                      CONF.token.expiration)
+        data_json = ','.join(jsonutils.dumps(dict(data, revoked_at=revoked_at))
+                             for data in token_refs)
+        if not self.client.append(bucket_key, ',%s' % data_json):
+            if not self.client.add(bucket_key, data_json, time=expires_ts):
+                if not self.client.append(bucket_key, ',%s' % data_json):
                     msg = _('Unable to add token to revocation list.')
                     raise exception.UnexpectedError(msg)
 
@@ -91,27 +158,60 @@ class Token(token.Driver):
         data = self.get_token(token_id)
         ptk = self._prefix_token_id(token_id)
         result = self.client.delete(ptk)
-        self._add_to_revocation_list(data)
+        self._add_to_revocation_list([data])
         return result
 
     def list_tokens(self, user_id, tenant_id=None):
         tokens = []
-        user_record = self.client.get('usertokens-%s' % user_id) or ""
-        token_list = jsonutils.loads('[%s]' % user_record)
-        for token_id in token_list:
-            ptk = self._prefix_token_id(token_id)
-            token_ref = self.client.get(ptk)
-            if token_ref:
-                if tenant_id is not None:
-                    if 'tenant' not in token_ref:
-                        continue
-                    if token_ref['tenant'].get('id') != tenant_id:
-                        continue
-                tokens.append(token_id)
+        for token_id, token_ref in self._get_user_tokens(user_id):
+            if tenant_id is not None:
+                if (token_ref.get('tenant') or {}).get('id') != tenant_id:
+                    continue
+            tokens.append(token_id)
         return tokens
 
-    def list_revoked_tokens(self):
-        list_json = self.client.get(self.revocation_key)
-        if list_json:
-            return jsonutils.loads('[%s]' % list_json)
-        return []
+    def revoke_tokens(self, user_id, tenant_id=None):
+        token_refs = dict(
+            (self._prefix_token_id(token_id), token_ref)
+            for token_id, token_ref in self._get_user_tokens(user_id)
+            if (tenant_id is None or
+                (token_ref.get('tenant') or {}).get('id') == tenant_id))
+        if not token_refs:
+            return
+        self.client.delete_multi(token_refs.keys())
+        self._add_to_revocation_list(token_refs.values())
+
+    def _read_legacy_revocation_list(self, list_json, now):
+        # Revocations used to be appended to a single key, which still
+        # holds those made before the upgrade, or by services not yet
+        # upgraded. Once every token in it has expired the key is emptied,
+        # unless another revocation was appended to it meanwhile.
+        tokens = jsonutils.loads('[%s]' % list_json)
+        live = [x for x in tokens if not x.get('expires') or
+                utils.parse_utc_isotime(x['expires']) > now]
+        if not live and self.client.gets(self.revocation_key) == list_json:
+            self.client.cas(self.revocation_key, '')
+        return live
+
+    def list_revoked_tokens(self, since=None):
+        now = timeutils.utcnow()
+        oldest = now - datetime.timedelta(seconds=CONF.token.expiration)
+        if since is not None and since > oldest:
+            oldest = since
+        bucket_keys = [self._revocation_bucket_key(bucket) for bucket in
+                       xrange(self._revocation_bucket(oldest),
+                              self._revocation_bucket(now) + 1)]
+        buckets = self.client.get_multi(bucket_keys + [self.revocation_key])
+        tokens = []
+        legacy_json = buckets.get(self.revocation_key)
+        if legacy_json:
+            tokens.extend(self._read_legacy_revocation_list(legacy_json,
+                                                            now))
+        for bucket_key in bucket_keys:
+            list_json = buckets.get(bucket_key)
+            if list_json:
+                tokens.extend(jsonutils.loads('[%s]' % list_json))
+        if since is not None:
+            tokens = [x for x in tokens if 'revoked_at' in x and
+                      utils.parse_utc_isotime(x['revoked_at']) >= since]
+        return tokens
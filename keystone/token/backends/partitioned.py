@@ -0,0 +1,266 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""SQL token driver partitioning tokens into tables by expiry window.
+
+Tokens expiring within the same ``[token] partition_time`` second window
+are stored in their own ``token_<window>`` table, created on demand with
+the columns of the regular ``token`` table. Once every token in a window
+has expired the whole table is dropped by ``flush_expired_tokens``, instead
+of its rows being deleted one by one.
+
+Lookups read only the partitions that can still hold live tokens, plus the
+regular ``token`` table, which keeps tokens that never expire or expire
+beyond the partitioned horizon, as well as any tokens issued before the
+driver was enabled. The partition a token was created in, or last found in,
+is remembered by each process and read first.
+
+Partitions are only created by ``create_token``, and ahead of time, for
+the next window too, by ``flush_expired_tokens``; lookups never create one
+and treat a missing partition as empty.
+
+"""
+
+import calendar
+import datetime
+import re
+
+import sqlalchemy
+
+from keystone.common import logging
+from keystone.common import utils
+from keystone import config
+from keystone import exception
+from keystone.openstack.common import timeutils
+from keystone.token.backends import sql
+
+
+CONF = config.CONF
+config.register_int('partition_time', group='token', default=3600)
+
+
+LOG = logging.getLogger(__name__)
+
+PARTITION_PREFIX = 'token_'
+PARTITION_NAME = re.compile(r'^%s(\d+)$' % PARTITION_PREFIX)
+
+VALID = sqlalchemy.literal(True)
+REVOKED = sqlalchemy.literal(False)
+
+
+class Token(sql.Token):
+    # number of token keys whose partition each process remembers
+    window_cache_size = 10000
+
+    def __init__(self):
+        super(Token, self).__init__()
+        self._metadata = sqlalchemy.MetaData()
+        self._created_windows = set()
+        self._token_windows = utils.LRUCache(self.window_cache_size)
+
+    def _window(self, at):
+        return calendar.timegm(at.utctimetuple()) // CONF.token.partition_time
+
+    def _window_end(self, window):
+        return (window + 1) * CONF.token.partition_time
+
+    def _partition(self, window):
+        name = '%s%d' % (PARTITION_PREFIX, window)
+        table = self._metadata.tables.get(name)
+        if table is None:
+            table = sqlalchemy.Table(
+                name, self._metadata,
+                *[column.copy() for column in sql.TokenModel.__table__.c])
+        return table
+
+    def _live_windows(self, now, ahead=0):
+        horizon = now + datetime.timedelta(
+            seconds=CONF.token.expiration + ahead)
+        return range(self._window(now), self._window(horizon) + 1)
+
+    def _create_partition(self, session, window):
+        table = self._partition(window)
+        try:
+            table.create(session.bind, checkfirst=True)
+        except sqlalchemy.exc.DBAPIError:
+            # another process created it since it was checked for
+            if not session.bind.has_table(table.name):
+                raise
+        self._created_windows.add(window)
+        return table
+
+    def _create_partitions(self, session, windows):
+        for window in windows:
+            if window not in self._created_windows:
+                self._create_partition(session, window)
+
+    def _live_tables(self, session, now):
+        """Returns the existing tables that may hold unexpired tokens."""
+        windows = self._live_windows(now)
+        if not self._created_windows.issuperset(windows):
+            # look for partitions created since, e.g. by another process
+            for name in session.bind.table_names():
+                match = PARTITION_NAME.match(name)
+                if match:
+                    self._created_windows.add(int(match.group(1)))
+        tables = [self._partition(window) for window in windows
+                  if window in self._created_windows]
+        tables.append(sql.TokenModel.__table__)
+        return tables
+
+    def _union(self, session, selects):
+        return session.execute(sqlalchemy.union_all(*selects))
+
+    # Public interface
+    def _select_token(self, t, key):
+        return sqlalchemy.select([t.c.id, t.c.expires, t.c.extra,
+                                  sqlalchemy.literal(t.name).label('table')])\
+                         .where(t.c.id == key)\
+                         .where(t.c.valid == VALID)
+
+    def get_token(self, token_id):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        key = self.token_to_key(token_id)
+        tables = self._live_tables(session, now)
+        token_ref = None
+        window = self._token_windows.get(key)
+        if window in self._live_windows(now):
+            token_ref = session.execute(
+                self._select_token(self._partition(window), key)).first()
+        if token_ref is None:
+            token_ref = self._union(session, [self._select_token(t, key)
+                                              for t in tables]).first()
+            match = token_ref and PARTITION_NAME.match(token_ref.table)
+            if match:
+                self._token_windows.set(key, int(match.group(1)))
+        if token_ref and (not token_ref.expires or now < token_ref.expires):
+            out = dict(token_ref.extra)
+            out['id'] = token_ref.id
+            out['expires'] = token_ref.expires
+            return out
+        else:
+            raise exception.TokenNotFound(token_id=token_id)
+
+    def create_token(self, token_id, data):
+        data_copy = dict(data)
+        if 'expires' not in data_copy:
+            data_copy['expires'] = self._get_default_expire_time()
+        expires = data_copy['expires']
+
+        session = self.get_session()
+        now = timeutils.utcnow()
+        if expires is None or self._window(expires) not in \
+                self._live_windows(now):
+            return super(Token, self).create_token(token_id, data_copy)
+
+        token_ref = sql.TokenModel.from_dict(data_copy)
+        token_ref.id = self.token_to_key(token_id)
+        token_ref.valid = True
+        window = self._window(expires)
+        # make sure the partition exists before writing to it
+        self._create_partitions(session, [window])
+        table = self._partition(window)
+        with session.begin():
+            session.execute(table.insert().values(
+                dict((c.name, getattr(token_ref, c.name)) for c in table.c)))
+        self._token_windows.set(token_ref.id, window)
+        return token_ref.to_dict()
+
+    def delete_token(self, token_id):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        key = self.token_to_key(token_id)
+        deleted = 0
+        with session.begin():
+            for t in self._live_tables(session, now):
+                deleted += session.execute(
+                    t.update()
+                     .where(t.c.id == key)
+                     .where(t.c.valid == VALID)
+                     .values(valid=False, revoked_at=now)).rowcount
+        if not deleted:
+            raise exception.TokenNotFound(token_id=token_id)
+
+    def _owned_by(self, t, now, user_id, tenant_id):
+        clause = sqlalchemy.and_(t.c.expires > now,
+                                 t.c.user_id == user_id,
+                                 t.c.valid == VALID)
+        if tenant_id is not None:
+            clause = sqlalchemy.and_(clause, t.c.tenant_id == tenant_id)
+        return clause
+
+    def list_tokens(self, user_id, tenant_id=None):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        return [token_ref.id for token_ref in self._union(session, [
+            sqlalchemy.select([t.c.id])
+                      .where(self._owned_by(t, now, user_id, tenant_id))
+            for t in self._live_tables(session, now)])]
+
+    def revoke_tokens(self, user_id, tenant_id=None):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        with session.begin():
+            for t in self._live_tables(session, now):
+                session.execute(
+                    t.update()
+                     .where(self._owned_by(t, now, user_id, tenant_id))
+                     .values(valid=False, revoked_at=now))
+
+    def list_revoked_tokens(self, since=None):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        selects = []
+        for t in self._live_tables(session, now):
+            select = sqlalchemy.select([t.c.id, t.c.expires])\
+                               .where(t.c.expires > now)\
+                               .where(t.c.valid == REVOKED)
+            if since is not None:
+                select = select.where(t.c.revoked_at >= since)
+            selects.append(select)
+        return [{'id': token_ref.id, 'expires': token_ref.expires}
+                for token_ref in self._union(session, selects)]
+
+    def flush_expired_tokens(self, batch_size=None):
+        """Drops partitions whose tokens have all expired.
+
+        Expired tokens in the regular token table are deleted in batches,
+        and the partitions of the next ``partition_time`` seconds are
+        created.
+
+        :returns: number of tokens deleted from the regular token table;
+                  dropped partitions are logged rather than counted
+
+        """
+        session = self.get_session()
+        now = timeutils.utcnow()
+        self._create_partitions(
+            session, self._live_windows(now, CONF.token.partition_time))
+        now_ts = calendar.timegm(now.utctimetuple())
+        for name in session.bind.table_names():
+            match = PARTITION_NAME.match(name)
+            if not match:
+                continue
+            window = int(match.group(1))
+            if self._window_end(window) > now_ts:
+                continue
+            table = self._partition(window)
+            table.drop(session.bind, checkfirst=True)
+            self._metadata.remove(table)
+            self._created_windows.discard(window)
+            LOG.info('Dropped expired token partition %s', name)
+        return super(Token, self).flush_expired_tokens(batch_size)
@@ -14,36 +14,45 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import copy
 import datetime
 import hashlib
 
 from keystone.common import cms
 from keystone.common import sql
+from keystone import config
 from keystone import exception
 from keystone.openstack.common import timeutils
 from keystone import token
 
 
+CONF = config.CONF
+
+
 class TokenModel(sql.ModelBase, sql.DictBase):
     __tablename__ = 'token'
     id = sql.Column(sql.String(64), primary_key=True)
-    expires = sql.Column(sql.DateTime(), default=None)
+    expires = sql.Column(sql.DateTime(), default=None, index=True)
     extra = sql.Column(sql.JsonBlob())
     valid = sql.Column(sql.Boolean(), default=True)
+    user_id = sql.Column(sql.String(64), index=True)
+    tenant_id = sql.Column(sql.String(64), index=True)
+    revoked_at = sql.Column(sql.DateTime(), index=True)
 
     @classmethod
     def from_dict(cls, token_dict):
         # shove any non-indexed properties into extra
-        extra = copy.deepcopy(token_dict)
+        extra = dict(token_dict)
         data = {}
         for k in ('id', 'expires'):
             data[k] = extra.pop(k, None)
+        # denormalize the owner so list_tokens can filter in the database
+        data['user_id'] = (extra.get('user') or {}).get('id')
+        data['tenant_id'] = (extra.get('tenant') or {}).get('id')
         data['extra'] = extra
         return cls(**data)
 
     def to_dict(self):
-        out = copy.deepcopy(self.extra)
+        out = dict(self.extra)
         out['id'] = self.id
         out['expires'] = self.expires
         return out
@@ -71,7 +80,7 @@ class Token(sql.Base, token.Driver):
             return token_id
 
     def create_token(self, token_id, data):
-        data_copy = copy.deepcopy(data)
+        data_copy = dict(data)
         if 'expires' not in data_copy:
             data_copy['expires'] = self._get_default_expire_time()
 
@@ -93,38 +102,70 @@ class Token(sql.Base, token.Driver):
             if not token_ref:
                 raise exception.TokenNotFound(token_id=token_id)
             token_ref.valid = False
+            token_ref.revoked_at = timeutils.utcnow()
             session.flush()
 
     def list_tokens(self, user_id, tenant_id=None):
         session = self.get_session()
-        tokens = []
         now = timeutils.utcnow()
-        for token_ref in session.query(TokenModel)\
-                                .filter(TokenModel.expires > now)\
-                                .filter_by(valid=True):
-            token_ref_dict = token_ref.to_dict()
-            if 'user' not in token_ref_dict:
-                continue
-            if token_ref_dict['user'].get('id') != user_id:
-                continue
+        query = session.query(TokenModel.id)\
+                       .filter(TokenModel.expires > now)\
+                       .filter_by(user_id=user_id, valid=True)
+        if tenant_id is not None:
+            query = query.filter_by(tenant_id=tenant_id)
+        return [token_ref.id for token_ref in query]
+
+    def revoke_tokens(self, user_id, tenant_id=None):
+        """Revoke the user's tokens and return the keys of those revoked."""
+        session = self.get_session()
+        now = timeutils.utcnow()
+        with session.begin():
+            query = session.query(TokenModel.id)\
+                           .filter(TokenModel.expires > now)\
+                           .filter_by(user_id=user_id, valid=True)\
+                           .with_lockmode('update')
             if tenant_id is not None:
-                if 'tenant' not in token_ref_dict:
-                    continue
-                if token_ref_dict['tenant'].get('id') != tenant_id:
-                    continue
-            tokens.append(token_ref['id'])
-        return tokens
+                query = query.filter_by(tenant_id=tenant_id)
+            token_keys = [token_ref.id for token_ref in query]
+            if token_keys:
+                session.query(TokenModel)\
+                       .filter(TokenModel.id.in_(token_keys))\
+                       .update({'valid': False, 'revoked_at': now},
+                               synchronize_session=False)
+        return token_keys
 
-    def list_revoked_tokens(self):
+    def list_revoked_tokens(self, since=None):
         session = self.get_session()
         tokens = []
         now = timeutils.utcnow()
-        for token_ref in session.query(TokenModel)\
-                                .filter(TokenModel.expires > now)\
-                                .filter_by(valid=False):
+        query = session.query(TokenModel)\
+                       .filter(TokenModel.expires > now)\
+                       .filter_by(valid=False)
+        if since is not None:
+            query = query.filter(TokenModel.revoked_at >= since)
+        for token_ref in query:
             record = {
                 'id': token_ref['id'],
                 'expires': token_ref['expires'],
             }
             tokens.append(record)
         return tokens
+
+    def flush_expired_tokens(self, batch_size=None):
+        batch_size = batch_size or CONF.token.flush_batch_size
+        session = self.get_session()
+        now = timeutils.utcnow()
+        count = 0
+        while True:
+            with session.begin():
+                token_ids = [token_ref.id for token_ref in
+                             session.query(TokenModel.id)
+                                    .filter(TokenModel.expires < now)
+                                    .limit(batch_size)]
+                if not token_ids:
+                    break
+                session.query(TokenModel)\
+                       .filter(TokenModel.id.in_(token_ids))\
+                       .delete(synchronize_session=False)
+            count += len(token_ids)
+        return count
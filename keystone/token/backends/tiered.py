@@ -0,0 +1,97 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Token driver keeping tokens in SQL with memcache in front of it.
+
+SQL remains the system of record: every write goes to the database first
+and listing and revocation queries are answered from it. Token lookups are
+served from memcache, which is filled from SQL on a miss, so losing a cache
+node only costs a database round trip per token.
+
+"""
+
+import calendar
+
+from keystone import exception
+from keystone.openstack.common import timeutils
+from keystone.token.backends import memcache
+from keystone.token.backends import sql
+
+
+# cached in place of a deleted or revoked token, so that a lookup which read
+# the token from SQL before it was deleted cannot add it back to the cache
+TOMBSTONE = 'deleted'
+
+
+class Token(sql.Token):
+    # seconds a tombstone is kept, longer than a lookup takes to fill the
+    # cache from SQL
+    tombstone_time = 60
+
+    def __init__(self, client=None):
+        super(Token, self).__init__()
+        self._cache = memcache.Token(client=client)
+
+    @property
+    def client(self):
+        return self._cache.client
+
+    def _cache_key(self, token_key):
+        return 'tiered-token-%s' % token_key.encode('utf-8')
+
+    def _cache_token(self, token_id, token_ref, replace=True):
+        kwargs = {}
+        if token_ref['expires'] is not None:
+            kwargs['time'] = calendar.timegm(
+                token_ref['expires'].utctimetuple())
+        store = self.client.set if replace else self.client.add
+        store(self._cache_key(self.token_to_key(token_id)),
+              token_ref, **kwargs)
+
+    def _bury_tokens(self, token_keys):
+        self.client.set_multi(dict((self._cache_key(token_key), TOMBSTONE)
+                                   for token_key in token_keys),
+                              time=self.tombstone_time)
+
+    # Public interface
+    def get_token(self, token_id):
+        token_ref = self.client.get(
+            self._cache_key(self.token_to_key(token_id)))
+        if token_ref is None:
+            token_ref = super(Token, self).get_token(token_id)
+            # never replaces a tombstone left by a concurrent delete
+            self._cache_token(token_id, token_ref, replace=False)
+        elif token_ref == TOMBSTONE:
+            raise exception.TokenNotFound(token_id=token_id)
+        elif (token_ref['expires'] is not None
+                and token_ref['expires'] <= timeutils.utcnow()):
+            raise exception.TokenNotFound(token_id=token_id)
+        return token_ref
+
+    def create_token(self, token_id, data):
+        token_ref = super(Token, self).create_token(token_id, data)
+        self._cache_token(token_id, token_ref)
+        return token_ref
+
+    def delete_token(self, token_id):
+        super(Token, self).delete_token(token_id)
+        self._bury_tokens([self.token_to_key(token_id)])
+
+    def revoke_tokens(self, user_id, tenant_id=None):
+        token_keys = super(Token, self).revoke_tokens(user_id, tenant_id)
+        if token_keys:
+            self._bury_tokens(token_keys)
+        return token_keys
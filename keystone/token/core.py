@@ -18,7 +18,12 @@
 
 import datetime
 
+import eventlet
+
+from keystone.common import cms
+from keystone.common import logging
 from keystone.common import manager
+from keystone.common import utils
 from keystone import config
 from keystone import exception
 from keystone.openstack.common import timeutils
@@ -26,6 +31,18 @@ from keystone.openstack.common import timeutils
 
 CONF = config.CONF
 config.register_int('expiration', group='token', default=86400)
+config.register_int('flush_batch_size', group='token', default=1000)
+config.register_int('flush_interval', group='token', default=0)
+config.register_int('revocation_cache_time', group='token', default=10)
+config.register_int('revocation_delta_overlap', group='token', default=60)
+config.register_int('cache_size', group='token', default=0)
+config.register_int('cache_time', group='token', default=60)
+config.register_bool('compact', group='token', default=False)
+config.register_bool('reuse', group='token', default=False)
+config.register_int('reuse_min_lifetime', group='token', default=3600)
+
+
+LOG = logging.getLogger(__name__)
 
 
 class Manager(manager.Manager):
@@ -36,8 +53,164 @@ class Manager(manager.Manager):
 
     """
 
+    # shared by every manager in the process and bumped on each revocation,
+    # so consumers of list_revoked_tokens can cheaply tell whether the list
+    # may have changed
+    _revocation_serial = 0
+
+    # read-through cache of token refs, likewise shared so that a token
+    # deleted through any manager is dropped for all of them
+    _cache = None
+
     def __init__(self):
         super(Manager, self).__init__(CONF.token.driver)
+        self._identity_api = None
+
+    @property
+    def identity_api(self):
+        if self._identity_api is None:
+            # imported here since keystone.identity itself imports this module
+            from keystone import identity
+            self._identity_api = identity.Manager()
+        return self._identity_api
+
+    @property
+    def revocation_serial(self):
+        return Manager._revocation_serial
+
+    @property
+    def cache(self):
+        """The token cache; exposes ``hits`` and ``misses`` counters."""
+        if Manager._cache is None:
+            Manager._cache = utils.LRUCache(CONF.token.cache_size)
+        return Manager._cache
+
+    def _tokens_revoked(self):
+        Manager._revocation_serial += 1
+
+    def _compact(self, data):
+        """Reduce a token ref to the ids it was issued for.
+
+        The user and tenant are stored by id only and the metadata, which
+        holds the role ids, is kept as is. The ``key`` attribute, the token
+        id as issued and so the whole signed document for PKI tokens, is
+        dropped unless ``[token] reuse`` needs it to hand the token out
+        again.
+
+        """
+        dropped = ('user', 'tenant') if CONF.token.reuse else \
+            ('user', 'tenant', 'key')
+        token_ref = dict((k, v) for k, v in data.iteritems()
+                         if k not in dropped)
+        token_ref['compact'] = True
+        token_ref['user'] = {'id': data['user']['id']}
+        if data.get('tenant'):
+            token_ref['tenant'] = {'id': data['tenant']['id']}
+        return token_ref
+
+    def _hydrate(self, context, token_id, token_ref):
+        """Load the user and tenant refs of a compact token."""
+        if not token_ref.get('compact'):
+            return token_ref
+        token_ref = dict(token_ref)
+        del token_ref['compact']
+        try:
+            token_ref['user'] = self.identity_api.get_user(
+                context, token_ref['user']['id'])
+            if token_ref.get('tenant'):
+                token_ref['tenant'] = self.identity_api.get_tenant(
+                    context, token_ref['tenant']['id'])
+        except (exception.UserNotFound, exception.TenantNotFound):
+            raise exception.TokenNotFound(token_id=token_id)
+        return token_ref
+
+    def create_token(self, context, token_id, data):
+        """Create a token, storing it in compact form if configured to.
+
+        With ``[token] compact`` enabled only the ids of the user, tenant and
+        roles are stored and the full refs are loaded again when the token
+        is read. Tokens stored in either form can always be read, so the
+        option can be switched at any time.
+
+        """
+        if not CONF.token.compact:
+            return self.driver.create_token(token_id, data)
+        token_ref = self.driver.create_token(token_id, self._compact(data))
+        return dict(data, expires=token_ref['expires'])
+
+    def get_token(self, context, token_id):
+        """Get a token by id, from the cache when possible.
+
+        Cached refs are kept for at most ``[token] cache_time`` seconds and
+        never past the expiry of the token itself. Whether cached or not,
+        the ref returned is a shallow copy of a frozen one, so its nested
+        values cannot be changed.
+
+        """
+        token_ref = self.cache.get(token_id)
+        if token_ref is None:
+            token_ref = utils.freeze(self._hydrate(
+                context, token_id, self.driver.get_token(token_id)))
+            expires = timeutils.utcnow() + datetime.timedelta(
+                seconds=CONF.token.cache_time)
+            if token_ref.get('expires') is not None:
+                expires = min(expires, token_ref['expires'])
+            self.cache.set(token_id, token_ref, expires)
+        return dict(token_ref)
+
+    def find_reusable_token(self, context, user_id, tenant_id, metadata,
+                            expires_before=None):
+        """Find an issued token that can be handed out again.
+
+        Returns None unless ``[token] reuse`` is enabled. A token qualifies
+        when it is scoped to the same user and tenant, carries the same
+        metadata (and so the same roles), has the configured
+        ``[signing] token_format``, has at least
+        ``[token] reuse_min_lifetime`` seconds left and, if given, does not
+        expire after ``expires_before``. The longest lived one is returned.
+
+        Backends keyed by a hash of long token ids list the hashes, so the
+        token id as issued is taken from the ``key`` attribute, which is
+        only trusted if it is, or hashes to, the id the token is stored
+        under; tokens without such a key are not reused.
+
+        :returns: token_ref whose ``id`` is the token id as issued, or None
+
+        """
+        if not CONF.token.reuse:
+            return None
+        earliest = timeutils.utcnow() + datetime.timedelta(
+            seconds=CONF.token.reuse_min_lifetime)
+        is_pki = CONF.signing.token_format == 'PKI'
+        reusable_ref = None
+        for token_id in self.list_tokens(context, user_id, tenant_id):
+            try:
+                token_ref = self.get_token(context, token_id)
+            except exception.TokenNotFound:
+                continue
+            expires = token_ref.get('expires')
+            if expires is None or expires < earliest:
+                continue
+            if expires_before is not None and expires > expires_before:
+                continue
+            if (token_ref.get('tenant') or {}).get('id') != tenant_id:
+                continue
+            if (token_ref.get('metadata') or {}) != (metadata or {}):
+                continue
+            key = token_ref.get('key')
+            if key is None or (key != token_id and
+                               utils.hash_signed_token(key) != token_id):
+                continue
+            if (len(key) > cms.UUID_TOKEN_LENGTH) != is_pki:
+                continue
+            if reusable_ref is None or expires > reusable_ref['expires']:
+                reusable_ref = dict(token_ref, id=key)
+        return reusable_ref
+
+    def delete_token(self, context, token_id):
+        self.cache.delete(token_id)
+        self.driver.delete_token(token_id)
+        self._tokens_revoked()
 
     def revoke_tokens(self, context, user_id, tenant_id=None):
         """Invalidates all tokens held by a user (optionally for a tenant).
@@ -45,12 +218,50 @@ class Manager(manager.Manager):
         If a specific tenant ID is not provided, *all* tokens held by user will
         be revoked.
         """
-        for token_id in self.list_tokens(context, user_id, tenant_id):
-            self.delete_token(context, token_id)
+        try:
+            self.driver.revoke_tokens(user_id, tenant_id)
+        except exception.NotImplemented:
+            for token_id in self.list_tokens(context, user_id, tenant_id):
+                self.delete_token(context, token_id)
+        # the driver does not say which tokens it revoked
+        self.cache.clear()
+        self._tokens_revoked()
+
+    def start_reaper(self, interval=None):
+        """Periodically flush expired tokens in a background greenthread.
+
+        :param interval: seconds between flushes, defaults to
+                         ``[token] flush_interval``
+        :returns: the spawned greenthread
+
+        """
+        interval = interval or CONF.token.flush_interval
+
+        def _reap():
+            while True:
+                eventlet.sleep(interval)
+                try:
+                    count = self.driver.flush_expired_tokens()
+                    LOG.debug('Flushed %s expired tokens', count)
+                except exception.NotImplemented:
+                    LOG.warning('Token driver does not support flushing '
+                                'expired tokens, stopping token reaper')
+                    return
+                except Exception:
+                    LOG.exception('Failed to flush expired tokens')
+
+        return eventlet.spawn(_reap)
 
 
 class Driver(object):
-    """Interface description for a Token driver."""
+    """Interface description for a Token driver.
+
+    Token refs returned by a driver are new dicts, but their nested values
+    may be shared with the driver's own storage instead of being copied. Such
+    values are frozen (see :func:`keystone.common.utils.freeze`) and must be
+    copied by callers that want to modify them.
+
+    """
 
     def get_token(self, token_id):
         """Get a token by id.
@@ -107,9 +318,11 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
-    def list_revoked_tokens(self):
+    def list_revoked_tokens(self, since=None):
         """Returns a list of all revoked tokens
 
+        :param since: only include tokens revoked at or after this naive utc
+                      datetime. Optional.
         :returns: list of token_id's
 
         """
@@ -118,11 +331,27 @@ class Driver(object):
     def revoke_tokens(self, user_id, tenant_id=None):
         """Invalidates all tokens held by a user (optionally for a tenant).
 
+        Drivers should implement this as a single bulk operation; the
+        manager falls back to deleting tokens one at a time otherwise.
+
         :raises: keystone.exception.UserNotFound,
                  keystone.exception.TenantNotFound
         """
         raise exception.NotImplemented()
 
+    def flush_expired_tokens(self, batch_size=None):
+        """Permanently removes expired tokens, including revoked ones.
+
+        Tokens are removed in chunks so that no single operation holds the
+        backend for long.
+
+        :param batch_size: tokens removed per chunk, defaults to
+                           ``[token] flush_batch_size``
+        :returns: number of tokens removed
+
+        """
+        raise exception.NotImplemented()
+
     def _get_default_expire_time(self):
         """Determine when a token should expire based on the config.
 
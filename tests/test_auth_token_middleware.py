@@ -15,9 +15,15 @@
 # under the License.
 
 import datetime
+import eventlet
+import hashlib
+import httplib
 import iso8601
 import os
+import socket
 import string
+import subprocess
+import sys
 import tempfile
 
 import webob
@@ -215,17 +221,23 @@ class FakeMemcache(object):
 
 
 class FakeHTTPResponse(object):
-    def __init__(self, status, body):
+    def __init__(self, status, body, headers=None):
         self.status = status
         self.body = body
+        self.headers = headers or {}
+        self.will_close = False
 
     def read(self):
         return self.body
 
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
 
 class FakeHTTPConnection(object):
 
     last_requested_url = ''
+    last_requested_headers = {}
 
     def __init__(self, *args):
         self.send_valid_revocation_list = True
@@ -242,6 +254,8 @@ class FakeHTTPConnection(object):
 
         """
         FakeHTTPConnection.last_requested_url = path
+        FakeHTTPConnection.last_requested_headers = kwargs.get('headers', {})
+        headers = {}
         if method == 'POST':
             status = 200
             body = jsonutils.dumps({
@@ -251,18 +265,25 @@ class FakeHTTPConnection(object):
             })
 
         else:
-            token_id = path.rsplit('/', 1)[1]
+            token_id = path.split('?', 1)[0].rsplit('/', 1)[1]
             if token_id in TOKEN_RESPONSES.keys():
                 status = 200
                 body = jsonutils.dumps(TOKEN_RESPONSES[token_id])
             elif token_id == "revoked":
-                status = 200
-                body = SIGNED_REVOCATION_LIST
+                headers['ETag'] = '"%s"' % hashlib.sha1(
+                    SIGNED_REVOCATION_LIST).hexdigest()
+                if (kwargs.get('headers', {}).get('If-None-Match') ==
+                        headers['ETag']):
+                    status = 304
+                    body = str()
+                else:
+                    status = 200
+                    body = SIGNED_REVOCATION_LIST
             else:
                 status = 404
                 body = str()
 
-        self.resp = FakeHTTPResponse(status, body)
+        self.resp = FakeHTTPResponse(status, body, headers)
 
     def getresponse(self):
         return self.resp
@@ -271,6 +292,37 @@ class FakeHTTPConnection(object):
         pass
 
 
+class CountingHTTPConnection(FakeHTTPConnection):
+    """Counts the connections made, of which the first one is broken.
+
+    A connection whose ``lost_response`` is set sends its request but
+    fails to read the response.
+
+    """
+
+    opened = []
+    broken = False
+    lost_response = False
+
+    def __init__(self, *args):
+        super(CountingHTTPConnection, self).__init__(*args)
+        self.closed = False
+        self.opened.append(self)
+
+    def request(self, method, path, **kwargs):
+        if self.closed or (self.broken and self is self.opened[0]):
+            raise socket.error(32, 'Broken pipe')
+        super(CountingHTTPConnection, self).request(method, path, **kwargs)
+
+    def getresponse(self):
+        if self.lost_response:
+            raise httplib.BadStatusLine('')
+        return super(CountingHTTPConnection, self).getresponse()
+
+    def close(self):
+        self.closed = True
+
+
 class FakeApp(object):
     """This represents a WSGI app protected by the auth_token middleware."""
     def __init__(self, expected_env=None):
@@ -308,6 +360,8 @@ class BaseAuthTokenMiddlewareTest(test.TestCase):
             'auth_port': 1234,
             'auth_admin_prefix': '/testadmin',
             'signing_dir': 'signing',
+            # refreshes are run by the tests themselves
+            'background_refresh': False,
         }
 
         self.middleware = auth_token.AuthProtocol(FakeApp(expected_env), conf)
@@ -439,6 +493,17 @@ class AuthTokenMiddlewareTest(BaseAuthTokenMiddlewareTest):
         result = self.middleware.is_signed_token_revoked(REVOKED_TOKEN)
         self.assertTrue(result)
 
+    def test_revoked_ids_are_built_once_per_list(self):
+        self.middleware.token_revocation_list = self.get_revocation_list_json()
+        revoked_ids = self.middleware._get_revoked_ids()
+        self.assertEqual(revoked_ids, set([REVOKED_TOKEN_HASH]))
+        self.assertTrue(self.middleware._get_revoked_ids() is revoked_ids)
+        self.middleware.token_revocation_list = jsonutils.dumps(
+            {"revoked": [], "extra": "success"})
+        self.assertEqual(self.middleware._get_revoked_ids(), set())
+        self.assertFalse(self.middleware.is_signed_token_revoked(
+            REVOKED_TOKEN))
+
     def test_verify_signed_token_raises_exception_for_revoked_token(self):
         self.middleware.token_revocation_list = self.get_revocation_list_json()
         with self.assertRaises(auth_token.InvalidUserToken):
@@ -490,6 +555,194 @@ class AuthTokenMiddlewareTest(BaseAuthTokenMiddlewareTest):
         fetched_list = jsonutils.loads(self.middleware.fetch_revocation_list())
         self.assertEqual(fetched_list, REVOCATION_LIST)
 
+    def test_fetch_revocation_list_since(self):
+        self.middleware.cms_verify = lambda data: data
+        self.middleware.fetch_revocation_list('2012-10-10T10:10:10Z')
+        self.assertEqual(FakeHTTPConnection.last_requested_url,
+                         '/testadmin/v2.0/tokens/revoked'
+                         '?since=2012-10-10T10%3A10%3A10Z')
+
+    def test_merge_revocation_list(self):
+        expired = timeutils.isotime(
+            timeutils.utcnow() - datetime.timedelta(minutes=1))
+        expires = timeutils.isotime(
+            timeutils.utcnow() + datetime.timedelta(minutes=1))
+        self.middleware.token_revocation_list = jsonutils.dumps(
+            {'revoked': [{'id': 'expired', 'expires': expired},
+                         {'id': 'kept', 'expires': expires}],
+             'timestamp': '2012-10-10T10:10:10Z'})
+        delta = jsonutils.dumps(
+            {'revoked': [{'id': 'new', 'expires': expires}],
+             'since': '2012-10-10T10:10:10Z',
+             'timestamp': '2012-10-10T10:10:20Z'})
+        merged = jsonutils.loads(
+            self.middleware._merge_revocation_list(delta))
+        self.assertEqual(sorted(x['id'] for x in merged['revoked']),
+                         ['kept', 'new'])
+        self.assertEqual(merged['timestamp'], '2012-10-10T10:10:20Z')
+
+    def test_merge_revocation_list_without_new_entries(self):
+        self.middleware.token_revocation_list = jsonutils.dumps(
+            {'revoked': [{'id': 'kept', 'expires': None}],
+             'timestamp': '2012-10-10T10:10:10Z'})
+        delta = jsonutils.dumps(
+            {'revoked': [{'id': 'kept', 'expires': None}],
+             'since': '2012-10-10T10:10:10Z',
+             'timestamp': '2012-10-10T10:10:20Z'})
+        merged = jsonutils.loads(
+            self.middleware._merge_revocation_list(delta))
+        self.assertEqual(merged['timestamp'], '2012-10-10T10:10:10Z')
+
+    def test_fetched_revocation_list_etag_is_sent(self):
+        self.middleware.cms_verify = lambda data: data
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': self.get_revocation_list_json()})
+        self.middleware._update_revocation_list()
+        self.assertNotIn('If-None-Match',
+                         FakeHTTPConnection.last_requested_headers)
+        self.assertTrue(self.middleware.is_signed_token_revoked(
+            REVOKED_TOKEN))
+
+        self.middleware._update_revocation_list()
+        self.assertEqual(
+            FakeHTTPConnection.last_requested_headers['If-None-Match'],
+            '"%s"' % hashlib.sha1(SIGNED_REVOCATION_LIST).hexdigest())
+
+    def test_unchanged_revocation_list_is_kept(self):
+        self.middleware.cms_verify = lambda data: data
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': self.get_revocation_list_json()})
+        self.middleware._update_revocation_list()
+        revocation_list = self.middleware._token_revocation_list
+        self.middleware.token_revocation_list_fetched_time = \
+            datetime.datetime.min
+        self.middleware.cms_verify = lambda data: self.fail('verified')
+        self.assertEqual(self.middleware.token_revocation_list,
+                         revocation_list)
+        self.assertEqual(self.middleware.token_revocation_list,
+                         revocation_list)
+        self.assertTrue(self.middleware.token_revocation_list_fetched_time >
+                        timeutils.utcnow() - datetime.timedelta(seconds=1))
+
+    def test_merge_full_revocation_list_replaces(self):
+        full = jsonutils.dumps({'revoked': [{'id': 'a', 'expires': None}],
+                                'timestamp': '2012-10-10T10:10:20Z'})
+        self.assertEqual(self.middleware._merge_revocation_list(full), full)
+
+    def test_stale_revocation_list_fetches_delta(self):
+        self.middleware.cms_verify = lambda data: data
+        self.middleware.token_revocation_list = jsonutils.dumps(
+            {'revoked': [{'id': 'a', 'expires': None}],
+             'timestamp': '2012-10-10T10:10:10Z'})
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': jsonutils.dumps(
+                {'revoked': [{'id': 'b', 'expires': None}],
+                 'since': '2012-10-10T10:10:10Z',
+                 'timestamp': '2012-10-10T10:10:20Z'})})
+        self.middleware._token_revocation_list_synced_time = \
+            timeutils.utcnow()
+        self.middleware.token_revocation_list_fetched_time = \
+            datetime.datetime.min
+        revocation_list = self.middleware.token_revocation_list
+        self.assertIn('since=', FakeHTTPConnection.last_requested_url)
+        self.assertEqual(sorted(x['id'] for x in revocation_list['revoked']),
+                         ['a', 'b'])
+        self.assertEqual(revocation_list['timestamp'], '2012-10-10T10:10:20Z')
+
+    def test_refresh_revocation_list(self):
+        self.middleware.cms_verify = lambda data: data
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': self.get_revocation_list_json()})
+        self.middleware._refresh_revocation_list()
+        self.assertTrue(self.middleware.is_signed_token_revoked(
+            REVOKED_TOKEN))
+
+    def test_failed_refresh_keeps_revocation_list(self):
+        revocation_list = self.middleware.token_revocation_list
+        globals()['SIGNED_REVOCATION_LIST'] = "{}"
+        self.middleware._refresh_revocation_list()
+        self.assertEqual(self.middleware._token_revocation_list,
+                         revocation_list)
+
+    def test_stale_revocation_list_is_used_while_refreshing(self):
+        self.middleware._refresher_pid = os.getpid()
+        revocation_list = self.middleware.token_revocation_list
+        self.middleware.token_revocation_list_fetched_time = (
+            timeutils.utcnow() -
+            self.middleware.token_revocation_list_cache_timeout)
+        FakeHTTPConnection.last_requested_url = ''
+        self.assertEqual(self.middleware.token_revocation_list,
+                         revocation_list)
+        self.assertEqual(FakeHTTPConnection.last_requested_url, '')
+
+    def test_token_revoked_after_refresh_is_rejected_while_refreshing(self):
+        self.middleware._refresher_pid = os.getpid()
+        self.middleware.token_revocation_list = jsonutils.dumps(
+            {'revoked': [], 'extra': 'success'})
+        self.middleware.token_revocation_list_fetched_time = (
+            timeutils.utcnow() -
+            self.middleware.token_revocation_list_cache_timeout -
+            self.middleware.revocation_refresh_grace)
+        self.middleware.cms_verify = lambda data: data
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': self.get_revocation_list_json()})
+        self.assertTrue(self.middleware.is_signed_token_revoked(
+            REVOKED_TOKEN))
+
+    def test_refresh_loop_honours_revocation_cache_time(self):
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            raise StopIteration()
+
+        self.middleware._prefetch_certs = lambda: None
+        self.middleware._refresh_revocation_list = lambda: None
+        self.stubs.Set(eventlet, 'sleep', sleep)
+        self.stubs.Set(auth_token.time, 'sleep', sleep)
+        self.assertRaises(StopIteration, self.middleware._refresh_loop)
+        self.assertEqual(slept, [1])
+
+    def test_refresher_is_started_once(self):
+        started = []
+        self.middleware.background_refresh = True
+        self.middleware._refresh_loop = lambda: started.append(None)
+        self.middleware._start_refresher()
+        self.middleware._start_refresher()
+        eventlet.sleep(0)
+        self.assertEqual(len(started), 1)
+
+    def test_refresher_is_started_by_pki_tokens_only(self):
+        started = []
+        self.middleware.background_refresh = True
+        self.middleware._refresh_loop = lambda: started.append(None)
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        eventlet.sleep(0)
+        self.assertEqual(started, [])
+        self.middleware.is_signed_token_revoked(REVOKED_TOKEN)
+        eventlet.sleep(0)
+        self.assertEqual(len(started), 1)
+
+    def test_prefetch_certs(self):
+        fetched = []
+        self.middleware.signing_cert_file_name = '/nonexistent/cert.pem'
+        self.middleware.ca_file_name = self.middleware.revoked_file_name
+        self.middleware.fetch_signing_cert = lambda: fetched.append('signing')
+        self.middleware.fetch_ca_cert = lambda: fetched.append('ca')
+        self.middleware._prefetch_certs()
+        self.assertEqual(fetched, ['signing'])
+
+    def test_revocation_list_is_fully_fetched_periodically(self):
+        self.middleware.cms_verify = lambda data: data
+        self.middleware._token_revocation_list_synced_time = (
+            timeutils.utcnow() - self.middleware.revocation_full_sync_interval)
+        globals()['SIGNED_REVOCATION_LIST'] = jsonutils.dumps(
+            {'signed': self.get_revocation_list_json()})
+        self.middleware._update_revocation_list()
+        self.assertNotIn('since=', FakeHTTPConnection.last_requested_url)
+        self.assertTrue(self.middleware.is_signed_token_revoked(
+            REVOKED_TOKEN))
+
     def test_request_invalid_uuid_token(self):
         req = webob.Request.blank('/')
         req.headers['X-Auth-Token'] = 'invalid-token'
@@ -544,6 +797,114 @@ class AuthTokenMiddlewareTest(BaseAuthTokenMiddlewareTest):
         self.middleware(req.environ, self.start_fake_response)
         self.assertEqual(len(self.middleware._cache.set_value), 2)
 
+    def test_local_cache_avoids_validation(self):
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        FakeHTTPConnection.last_requested_url = ''
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.assertEqual(FakeHTTPConnection.last_requested_url, '')
+
+    def test_local_cache_stores_invalid(self):
+        req = webob.Request.blank('/')
+        req.headers['X-Auth-Token'] = 'invalid-token'
+        self.middleware(req.environ, self.start_fake_response)
+        self.assertEqual(self.middleware._local_cache.get('invalid-token'),
+                         'invalid')
+        FakeHTTPConnection.last_requested_url = ''
+        self.middleware(req.environ, self.start_fake_response)
+        self.assertEqual(self.response_status, 401)
+        self.assertEqual(FakeHTTPConnection.last_requested_url, '')
+
+    def test_local_cache_is_bounded_in_bytes(self):
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        size = len(UUID_TOKEN_DEFAULT) + len(jsonutils.dumps(
+            TOKEN_RESPONSES[UUID_TOKEN_DEFAULT]))
+        self.assertEqual(self.middleware._local_cache.cost, size)
+
+        self.middleware._local_cache.clear()
+        self.middleware._local_cache.max_cost = size - 1
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.assertEqual(len(self.middleware._local_cache), 0)
+
+    def test_service_failure_is_not_cached_as_invalid(self):
+        def unreachable(*args, **kwargs):
+            raise auth_token.ServiceError('Unable to communicate '
+                                          'with keystone')
+
+        self.middleware._json_request = unreachable
+        req = webob.Request.blank('/')
+        req.headers['X-Auth-Token'] = UUID_TOKEN_DEFAULT
+        self.middleware(req.environ, self.start_fake_response)
+        self.assertIsNone(
+            self.middleware._local_cache.get(UUID_TOKEN_DEFAULT))
+        del self.middleware._json_request
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+
+    def test_local_cache_honors_token_expiry(self):
+        data = jsonutils.loads(jsonutils.dumps(
+            TOKEN_RESPONSES[UUID_TOKEN_DEFAULT]))
+        data['access']['token']['expires'] = timeutils.isotime(
+            timeutils.utcnow() - datetime.timedelta(minutes=1))
+        self.middleware._cache_put(UUID_TOKEN_DEFAULT, data)
+        self.assertEqual(self.middleware._cache_get(UUID_TOKEN_DEFAULT), None)
+
+    def test_local_cache_in_front_of_memcache(self):
+        req = webob.Request.blank('/')
+        req.headers['X-Auth-Token'] = SIGNED_TOKEN_SCOPED
+        self.middleware._cache = FakeMemcache()
+        self.middleware(req.environ, self.start_fake_response)
+        self.middleware._cache = None
+        self.middleware(req.environ, self.start_fake_response)
+        self.assertEqual(self.response_status, 200)
+
+    def test_cached_signed_token_is_checked_for_revocation(self):
+        self.middleware._cache_put(REVOKED_TOKEN,
+                                   TOKEN_RESPONSES[SIGNED_TOKEN_SCOPED])
+        self.middleware.token_revocation_list = self.get_revocation_list_json()
+        req = webob.Request.blank('/')
+        req.headers['X-Auth-Token'] = REVOKED_TOKEN
+        self.middleware(req.environ, self.start_fake_response)
+        self.assertEqual(self.response_status, 401)
+
+    def _validate_concurrently(self, token, count=5):
+        """Validate token from several greenthreads, returns their results."""
+        def validate():
+            try:
+                return self.middleware._validate_user_token(token)
+            except auth_token.InvalidUserToken as e:
+                return e
+
+        threads = [eventlet.spawn(validate) for i in range(count)]
+        return [thread.wait() for thread in threads]
+
+    def test_concurrent_validations_are_coalesced(self):
+        calls = []
+        verify_uuid_token = self.middleware.verify_uuid_token
+
+        def slow_verify_uuid_token(user_token, retry=True):
+            calls.append(user_token)
+            eventlet.sleep(0.01)
+            return verify_uuid_token(user_token, retry)
+
+        self.middleware.verify_uuid_token = slow_verify_uuid_token
+        results = self._validate_concurrently(UUID_TOKEN_DEFAULT)
+        self.assertEqual(calls, [UUID_TOKEN_DEFAULT])
+        self.assertEqual(results,
+                         [TOKEN_RESPONSES[UUID_TOKEN_DEFAULT]] * 5)
+
+    def test_coalesced_validations_share_failure(self):
+        calls = []
+
+        def failing_verify_uuid_token(user_token, retry=True):
+            calls.append(user_token)
+            eventlet.sleep(0.01)
+            raise auth_token.ServiceError()
+
+        self.middleware.verify_uuid_token = failing_verify_uuid_token
+        results = self._validate_concurrently('invalid-token')
+        self.assertEqual(len(calls), 1)
+        for result in results:
+            self.assertTrue(isinstance(result, auth_token.InvalidUserToken))
+
     def test_nomemcache(self):
         self.disable_module('memcache')
 
@@ -564,3 +925,97 @@ class AuthTokenMiddlewareTest(BaseAuthTokenMiddlewareTest):
         self.assertEqual(self.response_status, 200)
         self.assertFalse(req.headers.get('X-Service-Catalog'))
         self.assertEqual(body, ['SUCCESS'])
+
+    def test_http_connection_is_reused(self):
+        self.middleware.http_client_class = CountingHTTPConnection
+        CountingHTTPConnection.opened = []
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.middleware._local_cache.clear()
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.assertEqual(len(CountingHTTPConnection.opened), 1)
+        self.assertFalse(CountingHTTPConnection.opened[0].closed)
+
+    def test_broken_pooled_connection_is_replaced(self):
+        self.middleware.http_client_class = CountingHTTPConnection
+        CountingHTTPConnection.opened = []
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.stubs.Set(CountingHTTPConnection, 'broken', True)
+        self.middleware._local_cache.clear()
+        self.assert_valid_request_200(UUID_TOKEN_DEFAULT)
+        self.assertEqual(len(CountingHTTPConnection.opened), 2)
+        self.assertTrue(CountingHTTPConnection.opened[0].closed)
+
+    def test_only_idempotent_sent_requests_are_retried(self):
+        self.middleware.http_client_class = CountingHTTPConnection
+        CountingHTTPConnection.opened = []
+        conn = CountingHTTPConnection()
+        conn.lost_response = True
+        self.middleware._connection_pool.put(conn)
+        self.assertRaises(auth_token.ServiceError,
+                          self.middleware._send_request,
+                          'POST', '/v2.0/tokens')
+        self.assertEqual(len(CountingHTTPConnection.opened), 1)
+
+        conn = CountingHTTPConnection()
+        conn.lost_response = True
+        self.middleware._connection_pool.put(conn)
+        response, body = self.middleware._send_request(
+            'GET', '/v2.0/tokens/%s' % UUID_TOKEN_DEFAULT)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(CountingHTTPConnection.opened), 3)
+
+
+class HTTPConnectionPoolTest(test.TestCase):
+    def test_idle_connection_expires(self):
+        pool = auth_token.HTTPConnectionPool(1, 0)
+        conn = CountingHTTPConnection()
+        pool.put(conn)
+        self.assertEqual(pool.get(), None)
+        self.assertTrue(conn.closed)
+
+    def test_full_pool_closes_connection(self):
+        pool = auth_token.HTTPConnectionPool(1, 60)
+        kept, extra = CountingHTTPConnection(), CountingHTTPConnection()
+        pool.put(kept)
+        pool.put(extra)
+        self.assertTrue(extra.closed)
+        self.assertEqual(pool.get(), kept)
+        self.assertEqual(pool.get(), None)
+
+
+SINGLE_FLIGHT_SCRIPT = """
+import signal
+signal.alarm(30)
+
+import eventlet
+eventlet.monkey_patch(all=False, socket=True)
+
+from keystone.middleware import auth_token
+
+calls = []
+
+
+def validate():
+    calls.append(None)
+    eventlet.sleep(0.01)
+    return 'result'
+
+
+flight = auth_token._SingleFlight()
+threads = [eventlet.spawn(flight.call, 'token', validate) for i in range(2)]
+print [thread.wait() for thread in threads], len(calls)
+"""
+
+
+class SingleFlightTest(test.TestCase):
+    def test_greenthreads_wait_without_thread_patched(self):
+        # run_tests.py patches thread, as swift and glance do not, so this
+        # runs in an interpreter of its own
+        env = dict(os.environ, PYTHONPATH=test.ROOTDIR)
+        process = subprocess.Popen(
+            [sys.executable, '-c', SINGLE_FLIGHT_SCRIPT], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        self.assertEqual(output.strip().splitlines()[-1],
+                         "['result', 'result'] 1")
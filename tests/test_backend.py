@@ -19,6 +19,7 @@ import uuid
 import default_fixtures
 
 from keystone import exception
+from keystone import token
 from keystone.openstack.common import timeutils
 
 
@@ -646,6 +647,30 @@ class TokenTests(object):
         self.assertRaises(exception.TokenNotFound,
                           self.token_api.delete_token, token_id)
 
+    def test_token_ref_does_not_alias_storage(self):
+        token_id = self.create_token_sample_data()
+        token_ref = self.token_api.get_token(token_id)
+        token_ref['a'] = 'c'
+        token_ref = self.token_api.get_token(token_id)
+        self.assertEqual(token_ref['a'], 'b')
+
+    def test_manager_token_ref_is_frozen(self):
+        self.opt_in_group('token', cache_size=1000)
+        token_api = token.Manager()
+        token_api.driver = self.token_api
+        token_id = self.create_token_sample_data()
+        # from a cold cache, then from a warm one
+        for i in range(2):
+            token_ref = token_api.get_token({}, token_id)
+            token_ref['a'] = 'c'
+            self.assertRaises(TypeError, token_ref['user'].__setitem__,
+                              'id', 'otheruserid')
+        self.assertEqual(token_api.cache.misses, 1)
+        self.assertEqual(token_api.cache.hits, 1)
+        token_ref = token_api.get_token({}, token_id)
+        self.assertEqual(token_ref['a'], 'b')
+        self.assertEqual(token_ref['user']['id'], 'testuserid')
+
     def create_token_sample_data(self, tenant_id=None):
         token_id = uuid.uuid4().hex
         data = {'id': token_id, 'a': 'b',
@@ -694,6 +719,26 @@ class TokenTests(object):
         self.assertNotIn(token_id3, tokens)
         self.assertIn(token_id4, tokens)
 
+    def test_revoke_tokens(self):
+        tenant1 = uuid.uuid4().hex
+        tenant2 = uuid.uuid4().hex
+        token_id1 = self.create_token_sample_data(tenant_id=tenant1)
+        token_id2 = self.create_token_sample_data(tenant_id=tenant2)
+        token_id3 = self.create_token_sample_data()
+
+        self.token_api.revoke_tokens('testuserid', tenant1)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id1)
+        self.token_api.get_token(token_id2)
+        self.check_list_revoked_tokens([token_id1])
+
+        self.token_api.revoke_tokens('testuserid')
+        for token_id in (token_id2, token_id3):
+            self.assertRaises(exception.TokenNotFound,
+                              self.token_api.get_token, token_id)
+        self.check_list_revoked_tokens([token_id1, token_id2, token_id3])
+        self.assertEquals(self.token_api.list_tokens('testuserid'), [])
+
     def test_get_token_404(self):
         self.assertRaises(exception.TokenNotFound,
                           self.token_api.get_token,
@@ -745,6 +790,16 @@ class TokenTests(object):
             data_ref['id'])
         return token_id
 
+    def test_list_revoked_tokens_since(self):
+        token_id1 = self.delete_token()
+        since = timeutils.utcnow()
+        token_id2 = self.delete_token()
+        revoked_ids = [x['id'] for x in
+                       self.token_api.list_revoked_tokens(since=since)]
+        self.assertNotIn(token_id1, revoked_ids)
+        self.assertIn(token_id2, revoked_ids)
+        self.check_list_revoked_tokens([token_id1, token_id2])
+
     def test_list_revoked_tokens_returns_empty_list(self):
         revoked_ids = [x['id'] for x in self.token_api.list_revoked_tokens()]
         self.assertEqual(revoked_ids, [])
@@ -13,12 +13,14 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import datetime
 import uuid
 
 from keystone import catalog
 from keystone.catalog.backends import kvs as catalog_kvs
 from keystone import exception
 from keystone.identity.backends import kvs as identity_kvs
+from keystone.openstack.common import timeutils
 from keystone import test
 from keystone.token.backends import kvs as token_kvs
 
@@ -38,6 +40,27 @@ class KvsToken(test.TestCase, test_backend.TokenTests):
         super(KvsToken, self).setUp()
         self.token_api = token_kvs.Token(db={})
 
+    def test_expired_tokens_are_evicted(self):
+        expired = timeutils.utcnow() - datetime.timedelta(minutes=1)
+        expired_ids = []
+        for i in range(2):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(token_id, {'id': token_id,
+                                                   'expires': expired,
+                                                   'user': {'id': 'u'},
+                                                   'tenant': {'id': 't'}})
+            expired_ids.append(token_id)
+        live_id = uuid.uuid4().hex
+        self.token_api.create_token(live_id, {'id': live_id,
+                                              'user': {'id': 'u'}})
+
+        for token_id in expired_ids:
+            self.assertNotIn('token-%s' % token_id, self.token_api.db)
+        self.assertNotIn('tenant_tokens-t', self.token_api.db)
+        self.assertEqual(self.token_api.db['user_tokens-u'].keys(),
+                         [live_id])
+        self.assertEqual(self.token_api.flush_expired_tokens(), 0)
+
 
 class KvsCatalog(test.TestCase, test_backend.CatalogTests):
     def setUp(self):
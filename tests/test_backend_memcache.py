@@ -14,11 +14,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import calendar
+import copy
+import datetime
+import os
+import time
 import uuid
 
 import memcache
 
-from keystone.common import utils
+from keystone import config
 from keystone.openstack.common import timeutils
 from keystone import test
 from keystone.token.backends import memcache as token_memcache
@@ -26,17 +31,21 @@ from keystone.token.backends import memcache as token_memcache
 import test_backend
 
 
+CONF = config.CONF
+
+
 class MemcacheClient(object):
     """Replicates a tiny subset of memcached client interface."""
 
     def __init__(self, *args, **kwargs):
         """Ignores the passed in args."""
         self.cache = {}
+        self.cas_ids = {}
 
-    def add(self, key, value):
+    def add(self, key, value, time=0):
         if self.get(key):
             return False
-        return self.set(key, value)
+        return self.set(key, value, time=time)
 
     def append(self, key, value):
         existing_value = self.get(key)
@@ -53,16 +62,48 @@ class MemcacheClient(object):
         """Retrieves the value for a key or None."""
         self.check_key(key)
         obj = self.cache.get(key)
-        now = utils.unixtime(timeutils.utcnow())
+        now = calendar.timegm(timeutils.utcnow().utctimetuple())
         if obj and (obj[1] == 0 or obj[1] > now):
-            return obj[0]
+            # memcached hands back a fresh unpickled copy on every read
+            return copy.deepcopy(obj[0])
+
+    def get_multi(self, keys):
+        """Retrieves a dict of the values found for the given keys."""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def gets(self, key):
+        """Retrieves the value for a key and remembers it for cas."""
+        value = self.get(key)
+        if value is not None:
+            self.cas_ids[key] = self.cache[key]
+        return value
+
+    def cas(self, key, value, time=0):
+        """Sets the value for a key if it is unchanged since gets."""
+        if self.cas_ids.get(key) is not self.cache.get(key):
+            return False
+        return self.set(key, value, time=time)
 
     def set(self, key, value, time=0):
         """Sets the value for a key."""
         self.check_key(key)
-        self.cache[key] = (value, time)
+        if 0 < time <= 60 * 60 * 24 * 30:
+            # like memcached, up to 30 days is relative to now
+            time += calendar.timegm(timeutils.utcnow().utctimetuple())
+        self.cache[key] = (copy.deepcopy(value), time)
         return True
 
+    def set_multi(self, mapping, time=0):
+        """Sets the values for the keys of a dict."""
+        for key, value in mapping.iteritems():
+            self.set(key, value, time=time)
+        return []
+
     def delete(self, key):
         self.check_key(key)
         try:
@@ -71,6 +112,11 @@ class MemcacheClient(object):
             #NOTE(bcwaldon): python-memcached always returns the same value
             pass
 
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
 
 class MemcacheToken(test.TestCase, test_backend.TokenTests):
     def setUp(self):
@@ -84,3 +130,118 @@ class MemcacheToken(test.TestCase, test_backend.TokenTests):
                 'user': {'id': 'testuserid'}}
         self.token_api.create_token(token_id, data)
         self.token_api.get_token(token_id)
+
+    def test_revocation_list_is_bucketed(self):
+        token_id = uuid.uuid4().hex
+        data = {'id': token_id, 'a': 'b',
+                'user': {'id': 'testuserid'}}
+        self.token_api.create_token(token_id, data)
+        self.token_api.delete_token(token_id)
+
+        now = timeutils.utcnow()
+        bucket = self.token_api._revocation_bucket(now)
+        bucket_key = self.token_api._revocation_bucket_key(bucket)
+        value, expires_ts = self.token_api.client.cache[bucket_key]
+        self.assertIn(token_id, value)
+        self.assertTrue(expires_ts > calendar.timegm(
+            (now + datetime.timedelta(
+                seconds=CONF.token.expiration)).utctimetuple()))
+
+    def test_revocation_list_ignores_local_timezone(self):
+        old_tz = os.environ.get('TZ')
+
+        def restore_tz():
+            if old_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+
+        os.environ['TZ'] = 'EST+05EDT,M3.2.0,M11.1.0'
+        time.tzset()
+        self.addCleanup(restore_tz)
+
+        token_id = uuid.uuid4().hex
+        data = {'id': token_id, 'a': 'b',
+                'user': {'id': 'testuserid'}}
+        token_ref = self.token_api.create_token(token_id, data)
+        value, expires_ts = self.token_api.client.cache['token-%s' % token_id]
+        self.assertEqual(expires_ts, calendar.timegm(
+            token_ref['expires'].utctimetuple()))
+
+        self.token_api.delete_token(token_id)
+        now = timeutils.utcnow()
+        bucket = (calendar.timegm(now.utctimetuple()) //
+                  CONF.memcache.revocation_bucket_time)
+        self.assertIn(self.token_api._revocation_bucket_key(bucket),
+                      self.token_api.client.cache)
+        revoked = self.token_api.list_revoked_tokens(
+            since=now - datetime.timedelta(seconds=1))
+        self.assertEqual([x['id'] for x in revoked], [token_id])
+
+    def test_legacy_revocation_list_is_read(self):
+        expires = timeutils.utcnow() + datetime.timedelta(minutes=5)
+        self.token_api.client.set(
+            self.token_api.revocation_key,
+            '{"id": "legacy", "expires": "%s"}' % timeutils.isotime(expires))
+        revoked = self.token_api.list_revoked_tokens()
+        self.assertEqual([x['id'] for x in revoked], ['legacy'])
+        self.assertEqual(self.token_api.client.get(
+            self.token_api.revocation_key),
+            '{"id": "legacy", "expires": "%s"}' % timeutils.isotime(expires))
+
+    def test_expired_legacy_revocation_list_is_emptied(self):
+        expires = timeutils.utcnow() - datetime.timedelta(minutes=5)
+        self.token_api.client.set(
+            self.token_api.revocation_key,
+            '{"id": "legacy", "expires": "%s"}' % timeutils.isotime(expires))
+        self.assertEqual(self.token_api.list_revoked_tokens(), [])
+        self.assertEqual(self.token_api.client.get(
+            self.token_api.revocation_key), '')
+
+    def test_expired_revocation_bucket_is_not_read(self):
+        stale_at = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.token.expiration +
+            2 * CONF.memcache.revocation_bucket_time)
+        bucket = self.token_api._revocation_bucket(stale_at)
+        bucket_key = self.token_api._revocation_bucket_key(bucket)
+        self.token_api.client.set(bucket_key, '{"id": "stale"}')
+        self.assertEqual(self.token_api.list_revoked_tokens(), [])
+
+    def test_list_tokens_compacts_user_record(self):
+        token_ids = []
+        for i in range(3):
+            token_id = uuid.uuid4().hex
+            data = {'id': token_id, 'a': 'b',
+                    'user': {'id': 'testuserid'}}
+            self.token_api.create_token(token_id, data)
+            token_ids.append(token_id)
+        self.token_api.delete_token(token_ids[0])
+        self.token_api.delete_token(token_ids[1])
+
+        self.assertEqual(self.token_api.list_tokens('testuserid'),
+                         token_ids[2:])
+        user_record = self.token_api.client.get('usertokens-testuserid')
+        self.assertEqual(user_record, '"%s"' % token_ids[2])
+
+    def test_compaction_keeps_concurrently_added_token(self):
+        token_id = uuid.uuid4().hex
+        data = {'id': token_id, 'a': 'b', 'user': {'id': 'testuserid'}}
+        self.token_api.create_token(token_id, data)
+        self.token_api.delete_token(token_id)
+
+        client = self.token_api.client
+        gets = client.gets
+        new_token_id = uuid.uuid4().hex
+
+        def racing_gets(key):
+            value = gets(key)
+            new_data = {'id': new_token_id, 'user': {'id': 'testuserid'}}
+            self.token_api.create_token(new_token_id, new_data)
+            return value
+
+        client.gets = racing_gets
+        self.assertEqual(self.token_api.list_tokens('testuserid'), [])
+        client.gets = gets
+        self.assertEqual(self.token_api.list_tokens('testuserid'),
+                         [new_token_id])
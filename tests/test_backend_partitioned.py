@@ -0,0 +1,134 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import uuid
+
+import sqlalchemy
+
+from keystone.common.sql import util as sql_util
+from keystone import config
+from keystone.openstack.common import timeutils
+from keystone import test
+from keystone.token.backends import partitioned as token_partitioned
+from keystone.token.backends import sql as token_sql
+
+import test_backend
+
+
+CONF = config.CONF
+
+
+class PartitionedToken(test.TestCase, test_backend.TokenTests):
+    def setUp(self):
+        super(PartitionedToken, self).setUp()
+        self.config([test.etcdir('keystone.conf.sample'),
+                     test.testsdir('test_overrides.conf'),
+                     test.testsdir('backend_sql.conf')])
+        sql_util.setup_test_database()
+        self.token_api = token_partitioned.Token()
+
+    def tearDown(self):
+        timeutils.clear_time_override()
+        super(PartitionedToken, self).tearDown()
+
+    def partition_names(self):
+        engine = self.token_api.get_session().bind
+        return [name for name in engine.table_names()
+                if token_partitioned.PARTITION_NAME.match(name)]
+
+    def test_token_stored_in_partition(self):
+        token_id = self.create_token_sample_data()
+        token_ref = self.token_api.get_token(token_id)
+        window = self.token_api._window(token_ref['expires'])
+        self.assertIn('token_%d' % window, self.partition_names())
+        session = self.token_api.get_session()
+        self.assertIsNone(session.query(token_sql.TokenModel).get(token_id))
+
+    def test_token_without_expiry_stored_in_token_table(self):
+        token_id = uuid.uuid4().hex
+        self.token_api.create_token(token_id, {'id': token_id,
+                                               'expires': None,
+                                               'user': {'id': 'u'}})
+        session = self.token_api.get_session()
+        self.assertIsNotNone(session.query(token_sql.TokenModel)
+                                    .get(token_id))
+        self.assertEqual(self.token_api.list_tokens('u'), [])
+        self.token_api.get_token(token_id)
+
+    def test_flush_drops_expired_partitions(self):
+        token_id = self.create_token_sample_data()
+        names = self.partition_names()
+        self.assertTrue(names)
+
+        timeutils.set_time_override(
+            timeutils.utcnow() +
+            datetime.timedelta(seconds=CONF.token.expiration +
+                               CONF.token.partition_time))
+        self.token_api.flush_expired_tokens()
+        for name in names:
+            self.assertNotIn(name, self.partition_names())
+        self.assertRaises(token_partitioned.exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+    def test_get_token_reads_its_partition_first(self):
+        token_id = self.create_token_sample_data()
+
+        def union(*args):
+            self.fail('all partitions were read')
+
+        self.stubs.Set(self.token_api, '_union', union)
+        self.token_api.get_token(token_id)
+
+    def test_get_token_remembers_its_partition(self):
+        token_id = self.create_token_sample_data()
+        self.token_api = token_partitioned.Token()
+        self.token_api.get_token(token_id)
+        self.assertIsNotNone(self.token_api._token_windows.get(token_id))
+
+    def test_reads_create_no_partition(self):
+        token_id = uuid.uuid4().hex
+        self.assertRaises(token_partitioned.exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+        self.assertEqual(self.token_api.list_tokens('u'), [])
+        self.assertEqual(self.token_api.list_revoked_tokens(), [])
+        self.assertEqual(self.partition_names(), [])
+
+    def test_partition_created_by_another_process_is_read(self):
+        token_id = self.create_token_sample_data()
+        self.token_api = token_partitioned.Token()
+        self.stubs.Set(self.token_api, '_create_partition', None)
+        self.assertEqual(self.token_api.list_tokens('testuserid'),
+                         [token_id])
+
+    def test_flush_creates_next_partitions(self):
+        self.token_api.flush_expired_tokens()
+        horizon = timeutils.utcnow() + datetime.timedelta(
+            seconds=CONF.token.expiration + CONF.token.partition_time)
+        self.assertIn('token_%d' % self.token_api._window(horizon),
+                      self.partition_names())
+
+    def test_partition_created_concurrently(self):
+        create = sqlalchemy.Table.create
+
+        def create_in_two_processes(table, bind=None, checkfirst=False):
+            create(table, bind)
+            create(table, bind)
+
+        self.stubs.Set(sqlalchemy.Table, 'create', create_in_two_processes)
+        token_id = self.create_token_sample_data()
+        self.stubs.UnsetAll()
+        self.token_api.get_token(token_id)
@@ -14,15 +14,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import uuid
 
+import eventlet
+
 from keystone import catalog
 from keystone.catalog.backends import sql as catalog_sql
+from keystone.common import cms
 from keystone.common.sql import util as sql_util
 from keystone import config
 from keystone import exception
 from keystone.identity.backends import sql as identity_sql
+from keystone.openstack.common import timeutils
 from keystone import test
+from keystone import token
 from keystone.token.backends import sql as token_sql
 
 import default_fixtures
@@ -143,6 +149,175 @@ class SqlToken(test.TestCase, test_backend.TokenTests):
         sql_util.setup_test_database()
         self.token_api = token_sql.Token()
 
+    def test_token_owner_columns(self):
+        token_id = uuid.uuid4().hex
+        data = {'id': token_id, 'a': 'b',
+                'user': {'id': 'testuserid'},
+                'tenant': None}
+        self.token_api.create_token(token_id, data)
+        session = self.token_api.get_session()
+        token_ref = session.query(token_sql.TokenModel).get(token_id)
+        self.assertEqual(token_ref.user_id, 'testuserid')
+        self.assertIsNone(token_ref.tenant_id)
+        self.assertNotIn('user_id', self.token_api.get_token(token_id))
+        self.assertIn(token_id, self.token_api.list_tokens('testuserid'))
+
+    def test_flush_expired_tokens(self):
+        expired = timeutils.utcnow() - datetime.timedelta(minutes=1)
+        expired_ids = []
+        for i in range(3):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(token_id, {'id': token_id,
+                                                   'expires': expired,
+                                                   'user': {'id': 'u'}})
+            expired_ids.append(token_id)
+        self.token_api.delete_token(expired_ids[0])
+        live_id = self.create_token_sample_data()
+
+        self.assertEqual(self.token_api.flush_expired_tokens(batch_size=2), 3)
+        self.assertEqual(self.token_api.flush_expired_tokens(), 0)
+        session = self.token_api.get_session()
+        for token_id in expired_ids:
+            self.assertIsNone(session.query(token_sql.TokenModel)
+                                     .get(token_id))
+        self.token_api.get_token(live_id)
+
+    def test_token_manager_cache(self):
+        self.opt_in_group('token', cache_size=1000)
+        token_id = self.create_token_sample_data()
+        token_api = token.Manager()
+        token_api.get_token({}, token_id)
+        token_api.get_token({}, token_id)
+        self.assertEqual(token_api.cache.misses, 1)
+        self.assertEqual(token_api.cache.hits, 1)
+
+        token.Manager().delete_token({}, token_id)
+        self.assertRaises(exception.TokenNotFound,
+                          token_api.get_token, {}, token_id)
+
+        token_id = self.create_token_sample_data()
+        token_api.get_token({}, token_id)
+        token_api.revoke_tokens({}, 'testuserid')
+        self.assertRaises(exception.TokenNotFound,
+                          token_api.get_token, {}, token_id)
+
+    def test_compact_token_storage(self):
+        self.opt_in_group('token', compact=True)
+        self.identity_api = identity_sql.Identity()
+        self.load_fixtures(default_fixtures)
+        token_api = token.Manager()
+        token_id = uuid.uuid4().hex
+        token_api.create_token({}, token_id, {'id': token_id,
+                                              'key': token_id,
+                                              'user': self.user_foo,
+                                              'tenant': self.tenant_bar,
+                                              'metadata': {'roles': ['r']}})
+
+        stored_ref = self.token_api.get_token(token_id)
+        self.assertNotIn('key', stored_ref)
+        self.assertEqual(stored_ref['user'], {'id': self.user_foo['id']})
+        self.assertEqual(stored_ref['tenant'], {'id': self.tenant_bar['id']})
+        self.assertEqual(self.token_api.list_tokens(self.user_foo['id']),
+                         [token_id])
+
+        token_ref = token_api.get_token({}, token_id)
+        self.assertNotIn('compact', token_ref)
+        self.assertEqual(token_ref['user'],
+                         self.identity_api.get_user(self.user_foo['id']))
+        self.assertEqual(token_ref['tenant'],
+                         self.identity_api.get_tenant(self.tenant_bar['id']))
+        self.assertEqual(token_ref['metadata'], {'roles': ['r']})
+
+        self.identity_api.delete_user(self.user_foo['id'])
+        token_api.cache.clear()
+        self.assertRaises(exception.TokenNotFound,
+                          token_api.get_token, {}, token_id)
+
+    def test_compact_signed_token_storage(self):
+        self.opt_in_group('token', compact=True)
+        token_api = token.Manager()
+        token_id = 'MII' + 'x' * cms.UUID_TOKEN_LENGTH
+        token_api.create_token({}, token_id, {'id': token_id,
+                                              'key': token_id,
+                                              'user': {'id': 'u'},
+                                              'metadata': {}})
+
+        stored_ref = self.token_api.get_token(token_id)
+        self.assertNotIn(token_id, repr(stored_ref))
+
+    def test_find_reusable_token(self):
+        token_api = token.Manager()
+        self.assertIsNone(token_api.find_reusable_token({}, 'testuserid',
+                                                        None, {}))
+        self.opt_in_group('token', reuse=True)
+        self.assertIsNone(token_api.find_reusable_token({}, 'testuserid',
+                                                        None, {}))
+
+        token_id = uuid.uuid4().hex
+        token_api.create_token({}, token_id, {'id': token_id,
+                                              'key': token_id,
+                                              'user': {'id': 'testuserid'},
+                                              'tenant': {'id': 't'},
+                                              'metadata': {'roles': ['r']}})
+        token_ref = token_api.find_reusable_token({}, 'testuserid', 't',
+                                                  {'roles': ['r']})
+        self.assertEqual(token_ref['id'], token_id)
+        self.assertIsNone(token_api.find_reusable_token(
+            {}, 'testuserid', None, {'roles': ['r']}))
+        self.assertIsNone(token_api.find_reusable_token(
+            {}, 'testuserid', 't', {'roles': ['r', 's']}))
+        self.assertIsNone(token_api.find_reusable_token(
+            {}, 'testuserid', 't', {'roles': ['r']},
+            expires_before=timeutils.utcnow()))
+
+        self.opt_in_group('token', reuse_min_lifetime=CONF.token.expiration)
+        self.assertIsNone(token_api.find_reusable_token(
+            {}, 'testuserid', 't', {'roles': ['r']}))
+
+    def test_find_reusable_compact_signed_token(self):
+        self.opt_in_group('token', compact=True, reuse=True)
+        self.opt_in_group('signing', token_format='PKI')
+        self.identity_api = identity_sql.Identity()
+        self.load_fixtures(default_fixtures)
+        token_api = token.Manager()
+        token_id = 'MII' + 'x' * cms.UUID_TOKEN_LENGTH
+        token_api.create_token({}, token_id, {'id': token_id,
+                                              'key': token_id,
+                                              'user': self.user_foo,
+                                              'tenant': self.tenant_bar,
+                                              'metadata': {'roles': ['r']}})
+        token_ref = token_api.find_reusable_token(
+            {}, self.user_foo['id'], self.tenant_bar['id'], {'roles': ['r']})
+        self.assertEqual(token_ref['id'], token_id)
+        self.assertEqual(token_ref['user'],
+                         self.identity_api.get_user(self.user_foo['id']))
+
+        self.opt_in_group('signing', token_format='UUID')
+        self.assertIsNone(token_api.find_reusable_token(
+            {}, self.user_foo['id'], self.tenant_bar['id'], {'roles': ['r']}))
+
+    def test_find_reusable_token_checks_key(self):
+        self.opt_in_group('token', reuse=True)
+        token_api = token.Manager()
+        for key in (None, uuid.uuid4().hex):
+            token_id = uuid.uuid4().hex
+            token_api.create_token({}, token_id, {'id': token_id,
+                                                  'key': key,
+                                                  'user': {'id': 'u'}})
+        self.assertIsNone(token_api.find_reusable_token({}, 'u', None, {}))
+
+    def test_token_reaper(self):
+        expired = timeutils.utcnow() - datetime.timedelta(minutes=1)
+        token_id = uuid.uuid4().hex
+        self.token_api.create_token(token_id, {'id': token_id,
+                                               'expires': expired,
+                                               'user': {'id': 'u'}})
+        reaper = token.Manager().start_reaper(interval=0.01)
+        eventlet.sleep(0.1)
+        reaper.kill()
+        session = self.token_api.get_session()
+        self.assertIsNone(session.query(token_sql.TokenModel).get(token_id))
+
 
 class SqlCatalog(test.TestCase, test_backend.CatalogTests):
     def setUp(self):
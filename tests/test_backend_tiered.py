@@ -0,0 +1,98 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+
+from keystone.common.sql import util as sql_util
+from keystone import exception
+from keystone.openstack.common import timeutils
+from keystone import test
+from keystone.token.backends import sql as token_sql
+from keystone.token.backends import tiered as token_tiered
+
+import test_backend
+import test_backend_memcache
+
+
+class TieredToken(test.TestCase, test_backend.TokenTests):
+    def setUp(self):
+        super(TieredToken, self).setUp()
+        self.config([test.etcdir('keystone.conf.sample'),
+                     test.testsdir('test_overrides.conf'),
+                     test.testsdir('backend_sql.conf')])
+        sql_util.setup_test_database()
+        self.cache = test_backend_memcache.MemcacheClient()
+        self.token_api = token_tiered.Token(client=self.cache)
+
+    def test_get_token_survives_cache_loss(self):
+        token_id = self.create_token_sample_data()
+        self.cache.cache.clear()
+        self.token_api.get_token(token_id)
+        self.assertIn('tiered-token-%s' % token_id, self.cache.cache)
+
+    def test_get_token_from_cache(self):
+        token_id = self.create_token_sample_data()
+        self.token_api.get_session = None
+        self.token_api.get_token(token_id)
+
+    def test_delete_token_clears_cache(self):
+        token_id = self.create_token_sample_data()
+        self.token_api.delete_token(token_id)
+        self.assertEqual(self.cache.get('tiered-token-%s' % token_id),
+                         token_tiered.TOMBSTONE)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+    def test_revoke_tokens_clears_cache(self):
+        token_id = self.create_token_sample_data()
+        self.token_api.revoke_tokens('testuserid')
+        self.assertEqual(self.cache.get('tiered-token-%s' % token_id),
+                         token_tiered.TOMBSTONE)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+    def test_lookup_racing_delete_does_not_refill_cache(self):
+        token_id = self.create_token_sample_data()
+        self.cache.cache.clear()
+        sql_get_token = token_sql.Token.get_token
+
+        def get_token_then_delete(api, token_id):
+            # the token is deleted after the lookup read it from SQL
+            token_ref = sql_get_token(api, token_id)
+            self.token_api.delete_token(token_id)
+            return token_ref
+
+        self.stubs.Set(token_sql.Token, 'get_token', get_token_then_delete)
+        self.token_api.get_token(token_id)
+        self.stubs.UnsetAll()
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+    def test_revoke_tokens_returns_revoked_keys(self):
+        token_id = self.create_token_sample_data()
+        self.assertEqual(self.token_api.revoke_tokens('testuserid'),
+                         [token_id])
+        self.assertEqual(self.token_api.revoke_tokens('testuserid'), [])
+
+    def test_expired_token_in_cache(self):
+        token_id = self.create_token_sample_data()
+        key = 'tiered-token-%s' % token_id
+        token_ref, time = self.cache.cache[key]
+        token_ref['expires'] = (timeutils.utcnow() -
+                                datetime.timedelta(minutes=1))
+        self.cache.cache[key] = (token_ref, 0)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
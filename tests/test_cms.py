@@ -0,0 +1,170 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import eventlet
+import nose
+
+from keystone.common import cms
+from keystone.common import processpool
+from keystone import test
+
+
+SIGNING_PATH = os.path.join(test.TESTSDIR, 'signing')
+SIGNING_CERT = os.path.join(SIGNING_PATH, 'signing_cert.pem')
+SIGNING_KEY = os.path.join(SIGNING_PATH, 'private_key.pem')
+CA_CERT = os.path.join(SIGNING_PATH, 'cacert.pem')
+
+
+class LibCryptoCmsTest(test.TestCase):
+    def setUp(self):
+        super(LibCryptoCmsTest, self).setUp()
+        self.libcrypto = cms.get_libcrypto()
+        if self.libcrypto is None:
+            raise nose.exc.SkipTest('libcrypto is not available')
+
+    def test_sign_matches_openssl(self):
+        text = '{"access": {"token": {"id": "placeholder"}}}'
+        self.assertEqual(
+            self.libcrypto.sign(text, SIGNING_CERT, SIGNING_KEY),
+            cms._openssl_sign(text, SIGNING_CERT, SIGNING_KEY))
+
+    def test_verify_matches_openssl(self):
+        with open(os.path.join(SIGNING_PATH, 'auth_token_scoped.pem')) as f:
+            formatted = cms.token_to_cms(cms.cms_to_token(f.read()))
+        try:
+            expected = cms._openssl_verify(formatted, SIGNING_CERT, CA_CERT)
+        except subprocess.CalledProcessError:
+            self.assertRaises(subprocess.CalledProcessError,
+                              self.libcrypto.verify,
+                              formatted, SIGNING_CERT, CA_CERT)
+        else:
+            self.assertEqual(
+                self.libcrypto.verify(formatted, SIGNING_CERT, CA_CERT),
+                expected)
+
+    def test_missing_file_is_named_in_error(self):
+        missing = os.path.join(SIGNING_PATH, 'missing_cacert.pem')
+        try:
+            self.libcrypto.verify('', SIGNING_CERT, missing)
+        except subprocess.CalledProcessError as e:
+            self.assertIn(missing, e.output)
+        else:
+            self.fail('verify did not fail without a CA file')
+
+    def test_replaced_certificate_is_freed(self):
+        cert_file = os.path.join(tempfile.mkdtemp(), 'signing_cert.pem')
+        self.addCleanup(shutil.rmtree, os.path.dirname(cert_file))
+        shutil.copy(SIGNING_CERT, cert_file)
+        text = '{"access": {"token": {"id": "placeholder"}}}'
+        signed = self.libcrypto.sign(text, cert_file, SIGNING_KEY)
+        old_cert = self.libcrypto._files[('certificate', cert_file)][1]
+
+        freed = []
+        self.stubs.Set(self.libcrypto, 'X509_free', freed.append)
+        mtime = os.path.getmtime(cert_file)
+        os.utime(cert_file, (mtime + 10, mtime + 10))
+        self.assertEqual(self.libcrypto.sign(text, cert_file, SIGNING_KEY),
+                         signed)
+        self.assertEqual(freed, [old_cert])
+
+    def test_loaded_on_first_use(self):
+        env = dict(os.environ, PYTHONPATH=test.ROOTDIR)
+        output = subprocess.Popen(
+            [sys.executable, '-c',
+             'from keystone.common import cms; print cms._libcrypto_loaded'],
+            env=env, stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(output.strip(), 'False')
+
+
+class WorkerPoolCmsTest(test.TestCase):
+    def setUp(self):
+        super(WorkerPoolCmsTest, self).setUp()
+        cms.pool = processpool.WorkerPool(1, timeout=30)
+
+    def tearDown(self):
+        cms.pool.close()
+        cms.pool = None
+        super(WorkerPoolCmsTest, self).tearDown()
+
+    def test_sign_matches_in_process(self):
+        text = '{"access": {"token": {"id": "placeholder"}}}'
+        self.assertEqual(
+            cms.cms_sign_text(text, SIGNING_CERT, SIGNING_KEY),
+            cms._sign_text(text, SIGNING_CERT, SIGNING_KEY))
+
+    def test_sign_error_is_raised(self):
+        missing = os.path.join(SIGNING_PATH, 'missing_key.pem')
+        try:
+            cms.cms_sign_text('text', SIGNING_CERT, missing)
+        except subprocess.CalledProcessError as e:
+            self.assertNotEqual(e.returncode, 0)
+            self.assertIn(missing, e.output)
+        else:
+            self.fail('sign did not fail without a key file')
+
+    def test_worker_failure_is_raised_as_openssl_error(self):
+        cms.pool.timeout = 0
+        self.assertRaises(subprocess.CalledProcessError,
+                          cms.cms_sign_text,
+                          'text', SIGNING_CERT, SIGNING_KEY)
+
+
+class GreenCmsTest(test.TestCase):
+    def setUp(self):
+        super(GreenCmsTest, self).setUp()
+        self.stubs.Set(processpool, 'is_green', lambda: True)
+
+    def _count_ticks(self, func, *args):
+        """Counts how often another greenthread ran while func ran."""
+        ticks = []
+        done = []
+
+        def tick():
+            while not done:
+                ticks.append(None)
+                eventlet.sleep(0.01)
+
+        ticker = eventlet.spawn(tick)
+        eventlet.sleep(0)
+        try:
+            func(*args)
+        finally:
+            done.append(None)
+            ticker.wait()
+        return len(ticks)
+
+    def test_requests_progress_while_signing(self):
+        if cms.get_libcrypto() is None:
+            raise nose.exc.SkipTest('libcrypto is not available')
+
+        def slow_sign(text, cert, key):
+            # blocks the native thread, as a slow signature would
+            eventlet.patcher.original('time').sleep(0.3)
+            return 'signed'
+
+        self.stubs.Set(cms.get_libcrypto(), '_sign', slow_sign)
+        self.assertTrue(self._count_ticks(
+            cms.cms_sign_text, 'text', SIGNING_CERT, SIGNING_KEY) > 5)
+
+    def test_requests_progress_while_openssl_runs(self):
+        self.assertTrue(self._count_ticks(
+            lambda: processpool.popen(['sleep', '0.3']).communicate()) > 5)
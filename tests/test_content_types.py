@@ -14,15 +14,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import httplib
 import uuid
 
 from lxml import etree
 import nose.exc
 
+from keystone.common import cms
 from keystone.common import serializer
+from keystone.common import utils
 from keystone.openstack.common import jsonutils
+from keystone.openstack.common import timeutils
 from keystone import test
+from keystone import token
 
 import default_fixtures
 
@@ -367,6 +372,14 @@ class CoreApiTests(object):
             expected_status=200)
         self.assertValidAuthenticationResponse(r)
 
+    def test_authenticate_reuses_token(self):
+        self.opt_in_group('token', reuse=True)
+        token_id = self.get_scoped_token()
+        self.assertEqual(self.get_scoped_token(), token_id)
+
+        self.opt_in_group('token', reuse=False)
+        self.assertNotEqual(self.get_scoped_token(), token_id)
+
     def test_get_tenants_for_token(self):
         r = self.public_request(path='/v2.0/tenants',
                                 token=self.get_scoped_token())
@@ -634,6 +647,35 @@ class JsonTestCase(RestfulTestCase, CoreApiTests):
         r = self.admin_request(path=path, expected_status=401)
         self.assertValidErrorResponse(r)
 
+    def test_ec2_authenticate_reuses_token_of_configured_format(self):
+        self.opt_in_group('token', reuse=True)
+        token_id = self.get_scoped_token()
+        r = self.admin_request(
+            method='POST',
+            path='/v2.0/users/%s/credentials/OS-EC2' % self.user_foo['id'],
+            body={'tenant_id': self.tenant_bar['id']},
+            token=token_id)
+        credential = r.body['credential']
+        params = {'SignatureVersion': '0',
+                  'Action': 'Test',
+                  'Timestamp': '2012-10-10T10:10:10Z'}
+        signer = utils.Ec2Signer(credential['secret'])
+        credentials = {'access': credential['access'],
+                       'signature': signer.generate({'params': params}),
+                       'host': 'localhost',
+                       'verb': 'GET',
+                       'path': '/',
+                       'params': params}
+
+        r = self.admin_request(method='POST', path='/v2.0/ec2tokens',
+                               body={'credentials': credentials})
+        self.assertEqual(self._get_token_id(r), token_id)
+
+        self.opt_in_group('signing', token_format='PKI')
+        r = self.admin_request(method='POST', path='/v2.0/ec2tokens',
+                               body={'credentials': credentials})
+        self.assertNotEqual(self._get_token_id(r), token_id)
+
     def test_fetch_revocation_list_nonadmin_fails(self):
         self.admin_request(
             method='GET',
@@ -650,6 +692,134 @@ class JsonTestCase(RestfulTestCase, CoreApiTests):
             port=self._admin_port())
         self.assertValidRevocationListResponse(r)
 
+    def test_fetch_revocation_list_not_modified(self):
+        token = self.get_scoped_token()
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked',
+            token=token,
+            expected_status=200,
+            port=self._admin_port())
+        etag = r.getheader('ETag')
+        self.assertIsNotNone(etag)
+
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked',
+            token=token,
+            headers={'If-None-Match': etag},
+            expected_status=304,
+            port=self._admin_port())
+        self.assertEqual(r.getheader('ETag'), etag)
+
+        # revoking a token invalidates the cached list
+        self.admin_request(
+            method='DELETE',
+            path='/v2.0/tokens/%s' % self.get_scoped_token(),
+            token=token,
+            expected_status=204)
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked',
+            token=token,
+            headers={'If-None-Match': etag},
+            expected_status=200,
+            port=self._admin_port())
+        self.assertNotEqual(r.getheader('ETag'), etag)
+        self.assertValidRevocationListResponse(r)
+
+    def test_fetch_revocation_list_since(self):
+        token = self.get_scoped_token()
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked?since=2012-10-10T10%3A10%3A10Z',
+            token=token,
+            expected_status=200,
+            port=self._admin_port())
+        self.assertValidRevocationListResponse(r)
+        etag = r.getheader('ETag')
+        self.assertIsNotNone(etag)
+
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked?since=2012-10-10T10%3A10%3A10Z',
+            token=token,
+            headers={'If-None-Match': etag},
+            expected_status=304,
+            port=self._admin_port())
+        self.assertEqual(r.getheader('ETag'), etag)
+
+        self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked?since=yesterday',
+            token=token,
+            expected_status=400,
+            port=self._admin_port())
+
+    def test_unchanged_revocation_list_is_signed_once(self):
+        self.opt_in_group('token', revocation_cache_time=0)
+        signed = []
+
+        def sign(text, certfile, keyfile):
+            signed.append(text)
+            return text
+
+        self.stubs.Set(cms, 'cms_sign_text', sign)
+        token = self.get_scoped_token()
+        etags = []
+        for i in range(2):
+            r = self.restful_request(
+                method='GET',
+                path='/v2.0/tokens/revoked',
+                token=token,
+                expected_status=200,
+                port=self._admin_port())
+            etags.append(r.getheader('ETag'))
+        self.assertEqual(len(signed), 1)
+        self.assertEqual(etags[0], etags[1])
+
+    def test_revocation_list_delta_is_cached(self):
+        driver = token.Manager().driver
+        queries = []
+        list_revoked_tokens = driver.list_revoked_tokens
+
+        def count(*args, **kwargs):
+            queries.append(kwargs.get('since'))
+            return list_revoked_tokens(*args, **kwargs)
+
+        self.stubs.Set(type(driver), 'list_revoked_tokens',
+                       staticmethod(count))
+        token_id = self.get_scoped_token()
+        for i in range(2):
+            self.restful_request(
+                method='GET',
+                path='/v2.0/tokens/revoked?since=2012-10-10T10%3A10%3A10Z',
+                token=token_id,
+                expected_status=200,
+                port=self._admin_port())
+        self.assertEqual(len(queries), 1)
+
+    def test_revocation_list_delta_overlaps_since(self):
+        self.stubs.Set(cms, 'cms_sign_text', lambda text, cert, key: text)
+        token = self.get_scoped_token()
+        self.admin_request(
+            method='DELETE',
+            path='/v2.0/tokens/%s' % self.get_scoped_token(),
+            token=token,
+            expected_status=204)
+        # a poll whose timestamp is ahead of the revocation, e.g. from a
+        # keystone node with its clock ahead, still gets it
+        since = timeutils.isotime(
+            timeutils.utcnow() + datetime.timedelta(seconds=30))
+        r = self.restful_request(
+            method='GET',
+            path='/v2.0/tokens/revoked?since=%s' % since.replace(':', '%3A'),
+            token=token,
+            expected_status=200,
+            port=self._admin_port())
+        revoked = jsonutils.loads(r.body['signed'])['revoked']
+        self.assertEqual(len(revoked), 1)
+
     def assertValidRevocationListResponse(self, response):
         self.assertIsNotNone(response.body['signed'])
 
@@ -0,0 +1,115 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import httplib
+import os
+import signal
+
+import eventlet.patcher
+
+from keystone.common import launcher
+from keystone.common import wsgi
+from keystone import test
+
+
+def sleep_forever(slot):
+    eventlet.patcher.original('time').sleep(60)
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+
+class ProcessLauncherTest(test.TestCase):
+    def setUp(self):
+        super(ProcessLauncherTest, self).setUp()
+        self._handlers = dict(
+            (signo, signal.getsignal(signo))
+            for signo in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP))
+        self.launcher = launcher.ProcessLauncher()
+        self.launcher.restart_interval = 0
+
+    def tearDown(self):
+        self.launcher.stop()
+        for signo, handler in self._handlers.iteritems():
+            signal.signal(signo, handler)
+        super(ProcessLauncherTest, self).tearDown()
+
+    def test_crashed_worker_is_restarted(self):
+        self.launcher.launch(sleep_forever, 2)
+        self.assertEqual(sorted(self.launcher.children.values()), [0, 1])
+
+        pid = [pid for pid, slot in self.launcher.children.iteritems()
+               if slot == 1][0]
+        os.kill(pid, signal.SIGKILL)
+        new_pid = self.launcher._wait_child()
+        self.assertNotEqual(new_pid, pid)
+        self.assertEqual(self.launcher.children[new_pid], 1)
+        self.assertEqual(len(self.launcher.children), 2)
+
+    def test_reload_replaces_workers(self):
+        reloads = []
+        self.launcher.launch(sleep_forever, 2,
+                             reload=lambda: reloads.append(None))
+        old_pids = set(self.launcher.children)
+        self.launcher.reload()
+
+        self.assertEqual(len(reloads), 1)
+        self.assertEqual(sorted(self.launcher.children.values()), [0, 1])
+        self.assertFalse(old_pids & set(self.launcher.children))
+        self.assertEqual(self.launcher.retiring, old_pids)
+        # retired workers are not restarted when they exit
+        for pid in old_pids:
+            self.assertEqual(self.launcher._wait_child(), None)
+        self.assertEqual(self.launcher.retiring, set())
+        self.assertEqual(len(self.launcher.children), 2)
+
+    def test_failed_reload_keeps_workers(self):
+        def reload():
+            raise ValueError()
+
+        self.launcher.launch(sleep_forever, 1, reload=reload)
+        pids = dict(self.launcher.children)
+        self.launcher.reload()
+        self.assertEqual(self.launcher.children, pids)
+        self.assertEqual(self.launcher.retiring, set())
+
+    def test_stop_terminates_workers(self):
+        self.launcher.launch(sleep_forever, 2)
+        pids = list(self.launcher.children)
+        self.launcher.stop()
+        self.assertEqual(self.launcher.children, {})
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+    def test_workers_share_listening_socket(self):
+        server = wsgi.Server(pid_app, host='127.0.0.1', port=0)
+        server.listen(key='test')
+        host, port = server.socket_info['test']
+
+        def serve(slot):
+            server.start()
+            server.wait()
+
+        self.launcher.launch(serve, 2)
+        server.socket.close()
+        for i in range(10):
+            conn = httplib.HTTPConnection(host, port)
+            conn.request('GET', '/')
+            pid = int(conn.getresponse().read())
+            conn.close()
+            self.assertIn(pid, self.launcher.children)
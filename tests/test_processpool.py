@@ -0,0 +1,76 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import os
+import time
+
+import eventlet
+
+from keystone.common import processpool
+from keystone import exception
+from keystone import test
+
+
+class WorkerPoolTest(test.TestCase):
+    def setUp(self):
+        super(WorkerPoolTest, self).setUp()
+        self.pool = processpool.WorkerPool(1, timeout=30)
+
+    def tearDown(self):
+        self.pool.close()
+        super(WorkerPoolTest, self).tearDown()
+
+    def test_call_runs_in_worker(self):
+        pid = self.pool.call(os.getpid)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(self.pool.call(os.getpid), pid)
+
+    def test_error_is_raised(self):
+        try:
+            self.pool.call(os.stat, '/nonexistent')
+        except OSError as e:
+            self.assertEqual(e.errno, errno.ENOENT)
+        else:
+            self.fail('stat of a missing file did not fail')
+        # the worker survives errors raised by the function
+        self.assertEqual(self.pool._idle.qsize(), 1)
+
+    def test_crashed_worker_is_replaced(self):
+        pid = self.pool.call(os.getpid)
+        worker = self.pool._idle.queue[0]
+        worker.process.kill()
+        worker.process.wait()
+        self.assertNotEqual(self.pool.call(os.getpid), pid)
+
+    def test_timed_out_worker_is_killed(self):
+        self.pool.call(os.getpid)
+        worker = self.pool._idle.queue[0]
+        self.pool.timeout = 0.1
+        self.assertRaises(processpool.WorkerError,
+                          self.pool.call, time.sleep, 5)
+        self.assertFalse(worker.alive())
+        self.assertEqual(self.pool._idle.qsize(), 0)
+
+    def test_full_backlog_is_rejected(self):
+        self.stubs.Set(processpool, 'is_green', lambda: True)
+        self.pool.backlog = 0
+        busy = eventlet.spawn(self.pool.call, time.sleep, 0.3)
+        eventlet.sleep(0)
+        self.assertRaises(exception.ServiceUnavailable,
+                          self.pool.call, os.getpid)
+        busy.wait()
+        self.pool.call(os.getpid)
@@ -29,7 +29,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import datetime
+import pickle
+
 from keystone.common import utils
+from keystone.openstack.common import timeutils
 from keystone import test
 
 
@@ -58,8 +63,86 @@ class UtilsTestCase(test.TestCase):
         self.assertTrue(utils.check_password(password, hashed))
         self.assertFalse(utils.check_password(wrong, hashed))
 
+    def test_hash_in_crypt_workers(self):
+        self.opt(crypt_workers=1)
+        hashed = utils.hash_password('right')
+        self.assertTrue(utils.check_password('right', hashed))
+        self.assertFalse(utils.check_password('wrong', hashed))
+        self.assertEqual(utils._crypt_pool.size, 1)
+
     def test_auth_str_equal(self):
         self.assertTrue(utils.auth_str_equal('abc123', 'abc123'))
         self.assertFalse(utils.auth_str_equal('a', 'aaaaa'))
         self.assertFalse(utils.auth_str_equal('aaaaa', 'a'))
         self.assertFalse(utils.auth_str_equal('ABC123', 'abc123'))
+
+    def test_freeze(self):
+        value = {'a': {'b': [1, {'c': 2}]}}
+        frozen = utils.freeze(value)
+        self.assertEqual(frozen, value)
+        self.assertRaises(TypeError, frozen.__setitem__, 'd', 3)
+        self.assertRaises(TypeError, frozen['a'].pop, 'b')
+        self.assertRaises(TypeError, frozen['a']['b'].append, 3)
+        self.assertRaises(TypeError, frozen['a']['b'][1].update, {})
+        self.assertIs(utils.freeze(frozen), frozen)
+
+    def test_frozen_copies_are_mutable(self):
+        frozen = utils.freeze({'a': {'b': [1]}})
+        shallow = copy.copy(frozen)
+        shallow['d'] = 3
+        deep = copy.deepcopy(frozen)
+        deep['a']['b'].append(2)
+        self.assertEqual(frozen, {'a': {'b': [1]}})
+        self.assertEqual(type(pickle.loads(pickle.dumps(frozen))), dict)
+
+
+class LRUCacheTestCase(test.TestCase):
+    def tearDown(self):
+        timeutils.clear_time_override()
+        super(LRUCacheTestCase, self).tearDown()
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_expires(self):
+        cache = utils.LRUCache(2)
+        now = timeutils.utcnow()
+        timeutils.set_time_override(now)
+        cache.set('a', 1, expires=now + datetime.timedelta(seconds=5))
+        self.assertEqual(cache.get('a'), 1)
+        timeutils.advance_time_seconds(5)
+        self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache)
+
+    def test_counters(self):
+        cache = utils.LRUCache(2)
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_zero_size_disables(self):
+        cache = utils.LRUCache(0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_evicts_to_max_cost(self):
+        cache = utils.LRUCache(10, max_cost=10)
+        cache.set('a', 1, cost=4)
+        cache.set('b', 2, cost=4)
+        cache.set('c', 3, cost=4)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.cost, 8)
+        cache.set('d', 4, cost=11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
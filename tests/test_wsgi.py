@@ -14,6 +14,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import httplib
+
+import eventlet
 import webob
 
 from keystone.common import wsgi
@@ -76,3 +79,66 @@ class ApplicationTest(test.TestCase):
         self.assertEqual(resp.body, '')
         self.assertEqual(resp.headers.get('Content-Length'), '0')
         self.assertEqual(resp.headers.get('Content-Type'), None)
+
+
+def text_app(text, delay=0):
+    def app(environ, start_response):
+        eventlet.sleep(delay)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [text]
+    return app
+
+
+class ServerTest(test.TestCase):
+    def _start(self, app):
+        server = wsgi.Server(app, host='127.0.0.1', port=0)
+        server.start(key='socket')
+        self.addCleanup(server.kill)
+        return server
+
+    def _get(self, server):
+        host, port = server.socket_info['socket']
+        conn = httplib.HTTPConnection(host, port)
+        conn.request('GET', '/')
+        try:
+            return conn.getresponse().read()
+        finally:
+            conn.close()
+
+    def test_replaced_application_serves_new_requests(self):
+        server = self._start(text_app('old', delay=0.2))
+        in_progress = eventlet.spawn(self._get, server)
+        eventlet.sleep(0.05)
+        server.application = text_app('new')
+        self.assertEqual(self._get(server), 'new')
+        self.assertEqual(in_progress.wait(), 'old')
+
+    def test_stop_finishes_requests_in_progress(self):
+        server = self._start(text_app('done', delay=0.2))
+        in_progress = eventlet.spawn(self._get, server)
+        eventlet.sleep(0.05)
+        server.stop(timeout=5)
+        self.assertEqual(in_progress.wait(), 'done')
+
+    def test_stop_kills_requests_past_timeout(self):
+        server = self._start(text_app('done', delay=5))
+        eventlet.spawn_n(self._get, server)
+        eventlet.sleep(0.05)
+        with eventlet.Timeout(2):
+            server.stop(timeout=0.1)
+        self.assertEqual(len(server.pool.coroutines_running), 0)
+
+    def test_stopped_listener_accepts_no_connection(self):
+        sock = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        listener = wsgi._Listener(sock)
+        listener.accept_timeout = 0.05
+        accepting = eventlet.spawn(listener.accept)
+        eventlet.sleep(0)
+        listener.stop()
+        eventlet.sleep(0.1)
+        client = eventlet.connect(sock.getsockname())
+        self.addCleanup(client.close)
+        eventlet.sleep(0.05)
+        self.assertFalse(accepting.dead)
+        accepting.kill()